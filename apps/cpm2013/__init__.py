@@ -6,6 +6,10 @@ def get_urls():
 
     return patterns('',
         url(r'^page/(?P<slug>[\w\d_]+)', views.page, name='page'),
+        url(r'^api/preview-marks/$',
+            views.preview_marks, name='preview_marks'),
+        url(r'^api/previewers/(?P<previewer_id>\d+)/next/$',
+            views.next_preview, name='next_preview'),
         url(r'^', views.index, name='index'),
         # url(r'^volunteers/questionnaire', direct_to_template,
         #     {'template': 'cpm2013/volunteers_questionnaire.html'},
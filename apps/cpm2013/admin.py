@@ -1,8 +1,8 @@
 from functools import update_wrapper
-from itertools import chain, islice
+from itertools import chain, groupby, islice
+from operator import attrgetter
 import os
 import os.path
-import tempfile
 
 from django.conf import settings
 from django.contrib import admin
@@ -18,6 +18,7 @@ from django.core.exceptions import PermissionDenied
 from django.contrib.admin.util import unquote
 from django.db import transaction
 from django.core.urlresolvers import reverse
+from django.core.servers.basehttp import FileWrapper
 
 from hvad.admin import TranslatableAdmin
 from hvad.utils import get_translation_aware_manager
@@ -26,7 +27,13 @@ import openpyxl
 
 from apps.cpm2013.models import Submission, NewsEntry, Page, LetterTemplate,\
      Previewer, PreviewMark
-from apps.cpm2013.forms import FieldsForm, FileUploadForm
+from apps.cpm2013.exports import SubmissionExport, SubmissionImport
+from apps.cpm2013.constants import SECTIONS
+from apps.cpm2013.forms import FieldsForm, ImportForm, RankingForm
+from apps.cpm2013.assignments import update_queue
+from apps.cpm2013.marks import MarkImport, iter_sheet_marks
+from apps.cpm_common.export import get_text_response, iter_xlsx_rows
+from apps.cpm_common.jobs import start_export
 
 
 class PreviewFilter(admin.SimpleListFilter):
@@ -57,6 +64,7 @@ class SubmissionAdmin(admin.ModelAdmin):
                    PreviewFilter]
     ordering = ('-id',)
     save_on_top = True
+    actions = ['export_pdf_zip']
 
     fieldsets = [
             (_('Comments'), {
@@ -133,6 +141,9 @@ class SubmissionAdmin(admin.ModelAdmin):
             url(r'^recalc_marks/$',
                 wrap(self.calculate_view),
                 name='%s_%s_recalc_marks' % info),
+            url(r'^ranking/$',
+                wrap(self.ranking_view),
+                name='%s_%s_ranking' % info),
         ) + super(SubmissionAdmin, self).get_urls()
 
     def display_film_link(self, obj):
@@ -191,19 +202,53 @@ class SubmissionAdmin(admin.ModelAdmin):
         if not self.has_change_permission(request, obj):
             raise PermissionDenied
 
-        from apps.cpm2013.pdf import get_submission_confirmation_report
+        from apps.cpm2013.pdf import open_submission_confirmation
+        from apps.cpm2013.tasks import RenderSubmissionPdf
 
         current_lang = translation.get_language()
         try:
             translation.activate(obj.submission_language)
-            pdf = get_submission_confirmation_report(obj)
+            pdf_file = open_submission_confirmation(obj)
         finally:
             translation.activate(current_lang)
 
-        response = HttpResponse(pdf, content_type='application/pdf')
-        response['Content-Disposition'] = 'attachment; filename="cpm2013.pdf"'
+        if pdf_file is not None:
+            response = HttpResponse(
+                FileWrapper(pdf_file), content_type='application/pdf'
+            )
+            response['Content-Length'] = os.fstat(pdf_file.fileno()).st_size
+            response['Content-Disposition'] = 'attachment; '\
+                               'filename="cpm2013.pdf"'
+            return response
+
+        # rendering takes seconds, so it is done by celery while the
+        # status page below reloads itself until the file gets into cache
+        task_id = request.GET.get('task')
+        if task_id is not None:
+            result = RenderSubmissionPdf().AsyncResult(task_id)
+            if result.successful():
+                # rendered, but the submission was changed since then
+                task_id = None
+
+        if task_id is None:
+            result = RenderSubmissionPdf().apply_async(args=[obj.id])
+            return redirect('%s?task=%s' % (request.path, result.id))
 
-        return response
+        return render_to_response(
+            'admin/cpm2013/submission/pdf_status.html',
+            {'submission': obj, 'result': result},
+            context_instance=RequestContext(request),
+        )
+
+    def export_pdf_zip(self, request, queryset):
+        # rendering takes seconds per film, so the archive is built by
+        # celery while the status page polls its progress
+        job = start_export(
+            'apps.cpm2013.exports.SubmissionConfirmationsExport',
+            {'ids': list(queryset.values_list('id', flat=True))}
+        )
+        return redirect('export_status', job.id)
+    export_pdf_zip.short_description = _('Download PDF confirmations (ZIP)')
 
     def xlsx_view(self, request):
         if not self.has_change_permission(request):
@@ -211,42 +256,16 @@ class SubmissionAdmin(admin.ModelAdmin):
 
         form = FieldsForm(request.POST or None)
         if request.method == 'POST' and form.is_valid():
-            xlsx_file = tempfile.mktemp()
-            current_lang = translation.get_language()
+            params = {'fields': form.cleaned_data['fields']}
+            if form.cleaned_data['format'] != 'xlsx':
+                return get_text_response(
+                    SubmissionExport(params).iter_rows(),
+                    form.cleaned_data['format'], 'submissions',
+                    compress=form.cleaned_data['compress'],
+                )
 
-            try:
-                submissions = Submission.objects.all().order_by('id')
-
-                translation.activate('en')
-
-                from openpyxl import Workbook
-                wb = Workbook(optimized_write = True)
-                ws = wb.create_sheet()
-
-                ws.append(form.cleaned_data['fields'])
-                for s in submissions:
-                    row = []
-                    for field in form.cleaned_data['fields']:
-                        try:
-                            row.append(getattr(s, 'get_%s_display' % field)())
-                        except AttributeError:
-                            row.append(getattr(s, field))
-                    ws.append(row)
-                wb.save(xlsx_file)
-                with open(xlsx_file, 'r') as f:
-                    xlsx = f.read()
-            finally:
-                translation.activate(current_lang)
-                if os.path.exists(xlsx_file):
-                    os.unlink(xlsx_file)
-            response = HttpResponse(
-                xlsx,
-                content_type='application/vnd.openxmlformats-officedocument.'\
-                'spreadsheetml.sheet'
-            )
-            response['Content-Disposition'] = 'attachment; '\
-                               'filename="submissions.xlsx"'
-            return response
+            job = start_export('apps.cpm2013.exports.SubmissionExport', params)
+            return redirect('export_status', job.id)
 
         return render_to_response(
             'admin/cpm2013/submission/xlsx.html',
@@ -259,64 +278,33 @@ class SubmissionAdmin(admin.ModelAdmin):
         if not self.has_change_permission(request):
             raise PermissionDenied
         error = ''
+        changes = None
 
-        form = FileUploadForm(request.POST or None, request.FILES or None)
+        form = ImportForm(request.POST or None, request.FILES or None)
         if request.method == 'POST' and form.is_valid():
-            uploaded_file = form.cleaned_data['file']
+            dry_run = form.cleaned_data['dry_run']
 
             try:
-                from openpyxl import load_workbook
-                wb = load_workbook(filename=uploaded_file.temporary_file_path())
-                sheet0 = wb.get_sheet_by_name(wb.get_sheet_names()[0])
-
-                header = sheet0.rows[0]
-                allowed_fields = set(f.name for f in Submission._meta.fields)
-                for field in header:
-                    field = field.value
-                    if not field in allowed_fields:
-                        raise Exception('Invalid field %s' % field)
-
-                if header[0].value != 'id':
-                    raise Exception('First column must be id')
-
-                for index, row in enumerate(sheet0.rows[1:]):
-                    try:
-                        submission = Submission.objects.get(id=row[0].value)
-                    except Submission.DoesNotExist:
-                        raise Exception('Unknown submission %s' % (
-                            row[0]
-                        ))
-
-                    for index_h, field in enumerate(header[1:], 1):
-                        field_name = field.value
-                        field_obj = Submission._meta.get_field_by_name(field_name)[0]
-                        field_val = row[index_h].value
-
-                        if field_obj.choices:
-                            for k, v in field_obj.choices:
-                                if field_val in (k, unicode(v)):
-                                    setattr(submission, field_name, k)
-                                    break
-                            else:
-                                raise Exception('Submission %s: invalid %s' % (
-                                    submission.id, field
-                                ))
-                        else:
-                            setattr(submission, field_name, field_val)
-
-                    submission.save()
+                rows = iter_xlsx_rows(form.cleaned_data['file'])
+                submission_import = SubmissionImport(next(rows, []))
+                changes = submission_import.run(rows, dry_run=dry_run)
             except Exception as e:
                 error = unicode(e)
                 transaction.rollback()
             else:
-                transaction.commit()
-                error = 'done'
+                if dry_run:
+                    transaction.rollback()
+                else:
+                    transaction.commit()
+                    error = 'done'
 
         return render_to_response(
             'admin/cpm2013/submission/xlsx_upload.html',
             {
                 'form': form,
                 'error': error,
+                'changes': changes,
+                'imported': changes is not None,
             },
             context_instance=RequestContext(request),
         )
@@ -324,12 +312,43 @@ class SubmissionAdmin(admin.ModelAdmin):
 
     @transaction.commit_on_success
     def calculate_view(self, request):
-        for submission in Submission.objects.all():
-            submission.update_preview_mark()
-
+        Submission.update_preview_marks()
 
         return redirect('admin:cpm2013_submission_changelist')
 
+    def ranking_view(self, request):
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        error = ''
+        sections = []
+
+        form = RankingForm(request.GET or {'method': 'zscore'})
+        if form.is_valid():
+            from apps.cpm2013.ranking import MarkMatrix
+
+            try:
+                ranking = MarkMatrix.load().rank(form.cleaned_data['method'])
+            except ImportError:
+                error = _('Ranking requires NumPy to be installed')
+            else:
+                titles = dict(Submission.objects.values_list('id', 'title'))
+                section_names = dict(SECTIONS)
+                for section, rows in groupby(ranking, attrgetter('section')):
+                    sections.append((
+                        section_names.get(section, section),
+                        [(row, titles[row.id]) for row in rows],
+                    ))
+
+        return render_to_response(
+            'admin/cpm2013/submission/ranking.html',
+            {
+                'form': form,
+                'error': error,
+                'sections': sections,
+            },
+            context_instance=RequestContext(request),
+        )
+
 class NewsAdmin(TranslatableAdmin):
     list_display = ['display_title', 'added_at']
 
@@ -374,7 +393,31 @@ class LetterTemplateAdmin(TranslatableAdmin):
         return False
 
 class PreviewerAdmin(admin.ModelAdmin):
-    list_display = ['name', 'email']
+    list_display = ['name', 'email', 'preview_minutes']
+
+    def get_urls(self):
+        from django.conf.urls import patterns, url
+
+        def wrap(view):
+            def wrapper(*args, **kwargs):
+                return self.admin_site.admin_view(view)(*args, **kwargs)
+            return update_wrapper(wrapper, view)
+
+        info = self.model._meta.app_label, self.model._meta.module_name
+
+        return  patterns('',
+            url(r'^update_queue/$',
+                wrap(self.update_queue_view),
+                name='%s_%s_update_queue' % info),
+        ) + super(PreviewerAdmin, self).get_urls()
+
+    @transaction.commit_on_success
+    def update_queue_view(self, request):
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        update_queue()
+
+        return redirect('admin:cpm2013_previewer_changelist')
 
 class PreviewMarkAdmin(admin.ModelAdmin):
     list_display = ['mark', 'display_previewer', 'display_submission']
@@ -397,6 +440,56 @@ class PreviewMarkAdmin(admin.ModelAdmin):
     display_submission.short_description = 'Submission'
     display_submission.allow_tags = True
 
+    def get_urls(self):
+        from django.conf.urls import patterns, url
+
+        def wrap(view):
+            def wrapper(*args, **kwargs):
+                return self.admin_site.admin_view(view)(*args, **kwargs)
+            return update_wrapper(wrapper, view)
+
+        info = self.model._meta.app_label, self.model._meta.module_name
+
+        return  patterns('',
+            url(r'^xlsx_upload/$',
+                wrap(self.xlsx_upload_view),
+                name='%s_%s_xlsx_upload' % info),
+        ) + super(PreviewMarkAdmin, self).get_urls()
+
+    def xlsx_upload_view(self, request):
+        if not (self.has_add_permission(request) and
+                self.has_change_permission(request)):
+            raise PermissionDenied
+        error = ''
+        mark_import = None
+
+        form = ImportForm(request.POST or None, request.FILES or None)
+        if request.method == 'POST' and form.is_valid():
+            try:
+                rows = iter_xlsx_rows(form.cleaned_data['file'])
+                # the header is the first line
+                mark_import = MarkImport(first_line=2)
+                mark_import.run(
+                    iter_sheet_marks(rows),
+                    dry_run=form.cleaned_data['dry_run'],
+                )
+            except Exception as e:
+                error = unicode(e)
+                mark_import = None
+            else:
+                if not (mark_import.errors or form.cleaned_data['dry_run']):
+                    error = 'done'
+
+        return render_to_response(
+            'admin/cpm2013/previewmark/xlsx_upload.html',
+            {
+                'form': form,
+                'error': error,
+                'mark_import': mark_import,
+            },
+            context_instance=RequestContext(request),
+        )
+
     
 admin.site.register(Submission, SubmissionAdmin)
 admin.site.register(NewsEntry, NewsAdmin)
@@ -0,0 +1,245 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from apps.cpm_common.utils import chunks
+from apps.cpm2013.models import (
+    Previewer, PreviewAssignment, PreviewMark, PreviewQueueEntry, Submission
+)
+
+
+PREVIEW_ASSIGNMENT_MAX_AGE = getattr(
+    settings, 'PREVIEW_ASSIGNMENT_MAX_AGE', 14 * 24 * 60 * 60  # seconds
+)
+
+ASSIGN_ATTEMPTS = 3
+
+
+@transaction.commit_on_success
+def assign_next(previewer):
+    """
+    Gives the previewer a film to watch and returns it, or None when
+    every film is watched or assigned to the previewer already, or when
+    concurrent assignments keep taking the candidates
+
+    Films with the fewest marks and assignments go first. Of those,
+    a previewer who has got more minutes than average gets the shortest
+    film and others get the longest, so runtime evens out.
+    """
+    entries = PreviewQueueEntry.objects.exclude(
+        submission__in=PreviewMark.objects.filter(
+            previewer=previewer
+        ).values('submission')
+    ).exclude(
+        submission__in=PreviewAssignment.objects.filter(
+            previewer=previewer
+        ).values('submission')
+    )
+
+    average = Previewer.objects.aggregate(
+        average=models.Avg('preview_minutes')
+    )['average']
+    length = 'length' if previewer.preview_minutes > average else '-length'
+
+    for attempt in xrange(ASSIGN_ATTEMPTS):
+        # both lookups walk the (coverage, length) index, a mixed order
+        # like (coverage, -length) could not use it
+        coverage = entries.order_by('coverage').values_list(
+            'coverage', flat=True
+        )[:1]
+        if not coverage:
+            return None
+
+        # concurrent assignments may have moved every entry of the
+        # coverage up in between, then the lowest one is looked up again
+        found = entries.select_for_update().filter(
+            coverage=coverage[0]
+        ).order_by(length, 'submission')[:1]
+        if found:
+            entry = found[0]
+            break
+    else:
+        return None
+
+    sid = transaction.savepoint()
+    try:
+        PreviewAssignment.objects.create(
+            previewer=previewer, submission_id=entry.submission_id
+        )
+    except IntegrityError:
+        # a concurrent request of the previewer has got the same film,
+        # the queue and the minutes count it already
+        transaction.savepoint_rollback(sid)
+        return entry.submission
+    transaction.savepoint_commit(sid)
+
+    PreviewQueueEntry.objects.filter(pk=entry.pk).update(
+        coverage=F('coverage') + 1
+    )
+    Previewer.objects.filter(pk=previewer.pk).update(
+        preview_minutes=F('preview_minutes') + entry.length
+    )
+    previewer.preview_minutes += entry.length
+
+    return entry.submission
+
+
+def count_watched(previewer_id, submission_id, count=1):
+    """
+    Takes a new mark (``count=1``) or a removed one (``count=-1``) into
+    account, a mark on an assigned film closes the assignment
+    """
+    if count > 0:
+        assignment = PreviewAssignment.objects.filter(
+            previewer=previewer_id, submission=submission_id
+        )
+        if assignment.exists():
+            # coverage and minutes were counted on assignment
+            assignment.delete()
+            return
+
+    try:
+        length = Submission.objects.filter(
+            pk=submission_id
+        ).values_list('length', flat=True).get()
+    except Submission.DoesNotExist:
+        return
+
+    PreviewQueueEntry.objects.filter(submission=submission_id).update(
+        coverage=F('coverage') + count
+    )
+    Previewer.objects.filter(pk=previewer_id).update(
+        preview_minutes=F('preview_minutes') + length * count
+    )
+
+
+def _get_tables():
+    qn = connection.ops.quote_name
+    return {
+        'submission': qn(Submission._meta.db_table),
+        'mark': qn(PreviewMark._meta.db_table),
+        'assignment': qn(PreviewAssignment._meta.db_table),
+        'entry': qn(PreviewQueueEntry._meta.db_table),
+        'previewer': qn(Previewer._meta.db_table),
+    }
+
+
+def _filter(keyword, column, ids):
+    if ids is None:
+        return '', []
+    return ' %s %s IN (%s)' % (
+        keyword, column, ', '.join(['%s'] * len(ids))
+    ), list(ids)
+
+
+def _recount_entries(submission_ids=None):
+    # closes marked assignments, adds missing entries and recounts them,
+    # all of them when submission_ids is None
+    tables = _get_tables()
+    cursor = connection.cursor()
+
+    where, params = _filter('AND', 'submission_id', submission_ids)
+    cursor.execute(
+        'DELETE FROM %(assignment)s WHERE EXISTS ('
+        'SELECT 1 FROM %(mark)s m '
+        'WHERE m.previewer_id = %(assignment)s.previewer_id '
+        'AND m.submission_id = %(assignment)s.submission_id)' % tables +
+        where, params
+    )
+
+    where, params = _filter('AND', 's.id', submission_ids)
+    cursor.execute(
+        'INSERT INTO %(entry)s (submission_id, coverage, length) '
+        'SELECT s.id, 0, s.length FROM %(submission)s s '
+        'WHERE NOT EXISTS (SELECT 1 FROM %(entry)s e '
+        'WHERE e.submission_id = s.id)' % tables + where, params
+    )
+
+    where, params = _filter('WHERE', 'submission_id', submission_ids)
+    cursor.execute(
+        'UPDATE %(entry)s SET '
+        'length = (SELECT s.length FROM %(submission)s s '
+        'WHERE s.id = %(entry)s.submission_id), '
+        'coverage = (SELECT COUNT(*) FROM %(mark)s m '
+        'WHERE m.submission_id = %(entry)s.submission_id) + '
+        '(SELECT COUNT(*) FROM %(assignment)s a '
+        'WHERE a.submission_id = %(entry)s.submission_id)' % tables +
+        where, params
+    )
+
+
+def _recount_minutes(previewer_ids=None):
+    where, params = _filter('WHERE', 'id', previewer_ids)
+    connection.cursor().execute(
+        'UPDATE %(previewer)s SET preview_minutes = '
+        'COALESCE((SELECT SUM(s.length) FROM %(mark)s m '
+        'INNER JOIN %(submission)s s ON s.id = m.submission_id '
+        'WHERE m.previewer_id = %(previewer)s.id), 0) + '
+        'COALESCE((SELECT SUM(s.length) FROM %(assignment)s a '
+        'INNER JOIN %(submission)s s ON s.id = a.submission_id '
+        'WHERE a.previewer_id = %(previewer)s.id), 0)' % _get_tables() +
+        where, params
+    )
+
+
+def recount_queue(submission_ids, previewer_ids=()):
+    """
+    Recounts queue entries of the submissions, minutes of previewers
+    who have marked or been assigned them and of ``previewer_ids``
+
+    Marked assignments of the submissions are closed.
+    """
+    previewer_ids = set(previewer_ids)
+    for chunk in chunks(sorted(set(submission_ids))):
+        _recount_entries(chunk)
+        previewer_ids.update(PreviewMark.objects.filter(
+            submission__in=chunk
+        ).values_list('previewer_id', flat=True))
+        previewer_ids.update(PreviewAssignment.objects.filter(
+            submission__in=chunk
+        ).values_list('previewer_id', flat=True))
+
+    for chunk in chunks(sorted(previewer_ids)):
+        _recount_minutes(chunk)
+
+
+def expire_assignments():
+    """
+    Closes assignments older than PREVIEW_ASSIGNMENT_MAX_AGE
+    """
+    expired = PreviewAssignment.objects.filter(
+        assigned_at__lt=timezone.now() - timedelta(
+            seconds=PREVIEW_ASSIGNMENT_MAX_AGE
+        )
+    )
+    pairs = list(expired.values_list('id', 'previewer_id', 'submission_id'))
+    for chunk in chunks(pairs):
+        PreviewAssignment.objects.filter(
+            pk__in=[pk for pk, previewer_id, submission_id in chunk]
+        ).delete()
+
+    recount_queue(
+        [submission_id for pk, previewer_id, submission_id in pairs],
+        [previewer_id for pk, previewer_id, submission_id in pairs],
+    )
+    return len(pairs)
+
+
+def update_queue():
+    """
+    Rebuilds the queue and previewer minutes from marks and assignments
+
+    Assignments that are marked or older than PREVIEW_ASSIGNMENT_MAX_AGE
+    are closed, submissions missing from the queue are added.
+    """
+    PreviewAssignment.objects.filter(
+        assigned_at__lt=timezone.now() - timedelta(
+            seconds=PREVIEW_ASSIGNMENT_MAX_AGE
+        )
+    ).delete()
+
+    _recount_entries()
+    _recount_minutes()
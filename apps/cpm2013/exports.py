@@ -0,0 +1,62 @@
+from django.utils import timezone
+
+from apps.cpm_common.imports import ModelImport
+from apps.cpm_common.jobs import ConfirmationsExport, ModelExport
+from apps.cpm2013.models import PendingEmailUpdate, Submission
+
+
+class SubmissionExport(ModelExport):
+    model = Submission
+    filename = 'submissions.xlsx'
+
+
+class SubmissionConfirmationsExport(ConfirmationsExport):
+    model = Submission
+    prefix = 'cpm2013'
+
+    def iter_confirmations(self, submissions):
+        from apps.cpm2013.pdf import iter_submission_confirmations
+        return iter_submission_confirmations(submissions)
+
+
+class SubmissionImport(ModelImport):
+    model = Submission
+
+    def apply(self, changed):
+        # the same bookkeeping Submission.save() does for changed facts
+        now = timezone.now()
+        for obj, changes in changed:
+            names = set(name for name, old, new in changes)
+            for name, old, new in list(changes):
+                date_field = Submission.FACT_DATES.get(name)
+                if date_field and date_field not in names:
+                    changes.append((
+                        date_field, getattr(obj, date_field),
+                        now if new == True else None,
+                    ))
+
+        super(SubmissionImport, self).apply(changed)
+
+        from apps.cpm2013.pdf import invalidate_submission_confirmation
+        new_facts = {}
+        for obj, changes in changed:
+            invalidate_submission_confirmation(obj)
+
+            facts = [
+                name for name, old, new in changes
+                if name in Submission.EMAILED_FACTS and new
+            ]
+            if facts:
+                new_facts[obj.pk] = facts
+
+        if new_facts:
+            PendingEmailUpdate.schedule_many(new_facts, countdown=60 * 20)
+
+        length_changed = [
+            obj.pk for obj, changes in changed
+            if any(name == 'length' for name, old, new in changes)
+        ]
+        if length_changed:
+            # queue lengths and previewer minutes follow film lengths
+            from apps.cpm2013.assignments import recount_queue
+            recount_queue(length_changed)
@@ -4,7 +4,9 @@ from django.forms.util import ErrorList
 
 from form_utils.forms import BetterModelForm
 
+from apps.cpm_common.export import FORMAT_CHOICES
 from apps.cpm2013.models import Submission
+from apps.cpm2013.ranking import METHOD_CHOICES
 from validators import validate_checked
 
 
@@ -79,19 +81,26 @@ class SubmissionForm(BetterModelForm):
         ]
 
 
+# only editable fields can be imported back
+EXPORT_FIELDS = [f.name for f in Submission._meta.fields if f.editable]
+
+
 class FieldsForm(forms.Form):
     fields = forms.MultipleChoiceField(
-        choices=[(f.name, f.name) for f in Submission._meta.fields],
+        choices=[(name, name) for name in EXPORT_FIELDS],
         widget=forms.CheckboxSelectMultiple
     )
+    format = forms.ChoiceField(choices=FORMAT_CHOICES, initial='xlsx')
+    compress = forms.BooleanField(
+        label=_('Gzip'), required=False,
+        help_text=_('CSV and JSON lines only, XLSX is compressed anyway')
+    )
 
     def __init__(self, data=None, files=None, auto_id='id_%s', prefix=None,
                  initial=None, error_class=ErrorList, label_suffix=':',
                  empty_permitted=False):
         if initial is None:
-            initial = {
-                'fields': [f.name for f in Submission._meta.fields]
-            }
+            initial = {'fields': EXPORT_FIELDS}
         super(FieldsForm, self).__init__(
             data, files, auto_id, prefix, initial, error_class,
             label_suffix, empty_permitted
@@ -99,3 +108,16 @@ class FieldsForm(forms.Form):
 
 class FileUploadForm(forms.Form):
     file = forms.FileField(required=True)
+
+
+class ImportForm(FileUploadForm):
+    dry_run = forms.BooleanField(
+        label=_('Dry run'), required=False, initial=True,
+        help_text=_('Only show the changes, nothing is saved')
+    )
+
+
+class RankingForm(forms.Form):
+    method = forms.ChoiceField(
+        label=_('Normalization'), choices=METHOD_CHOICES, initial='zscore'
+    )
@@ -0,0 +1,200 @@
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+
+from apps.cpm_common.imports import InvalidImport
+from apps.cpm_common.utils import chunks
+from apps.cpm2013 import previews
+from apps.cpm2013.assignments import recount_queue
+from apps.cpm2013.models import Previewer, PreviewMark, Submission
+
+
+MARK_COLUMNS = ('previewer', 'submission', 'mark')
+
+
+def iter_sheet_marks(rows):
+    """
+    Turns spreadsheet rows with a ``previewer``, ``submission`` and
+    ``mark`` header into ``(previewer, submission, mark)`` rows
+    """
+    header = [
+        unicode(name).strip().lower() if name is not None else None
+        for name in next(rows, [])
+    ]
+    try:
+        columns = [header.index(name) for name in MARK_COLUMNS]
+    except ValueError:
+        raise InvalidImport('Columns must be %s' % ', '.join(MARK_COLUMNS))
+
+    for row in rows:
+        row = list(row) + [None] * (len(header) - len(row))
+        yield [row[column] for column in columns]
+
+
+class MarkImport(object):
+    """
+    Validates and saves preview marks given as
+    ``(previewer, submission, mark)`` rows.
+
+    Previewers are given by id or email, submissions by id. An existing
+    mark of the previewer on the submission is replaced. All rows are
+    checked before anything is written, marks are written with one
+    INSERT or UPDATE per few hundred of them, and preview results of the
+    affected submissions and the preview queue are recalculated once at
+    the end. Marks saved by someone else in the meantime are reported as
+    errors and nothing is written.
+
+    ``run`` fills ``errors`` and ``duplicates`` with ``(line, message)``
+    items and counts ``created``, ``updated`` and ``unchanged`` marks.
+    """
+    def __init__(self, first_line=1):
+        self.first_line = first_line
+        self.errors = []
+        self.duplicates = []
+        self.created = self.updated = self.unchanged = 0
+
+    def _get_previewers(self):
+        previewers = {}
+        emails = defaultdict(list)
+        for pk, email in Previewer.objects.values_list('id', 'email'):
+            previewers[pk] = pk
+            emails[email.strip().lower()].append(pk)
+
+        for email, pks in emails.iteritems():
+            # the same person registered twice can't be told apart
+            previewers[email] = pks[0] if len(pks) == 1 else None
+        return previewers
+
+    def _to_int(self, value):
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        if isinstance(value, basestring) and value.strip().isdigit():
+            value = int(value)
+        if isinstance(value, bool) or not isinstance(value, (int, long)):
+            raise ValueError(value)
+        return value
+
+    def _parse(self, rows):
+        previewers = self._get_previewers()
+        marks = {}
+        for line, row in enumerate(rows, self.first_line):
+            if not any(value not in (None, '') for value in row):
+                continue
+
+            previewer, submission, mark = row
+            try:
+                previewer = self._to_int(previewer)
+            except ValueError:
+                previewer = unicode(previewer or '').strip().lower()
+            previewer_id = previewers.get(previewer)
+            if previewer_id is None:
+                self.errors.append(
+                    (line, u'Unknown previewer %s' % previewer)
+                )
+                continue
+
+            try:
+                submission_id = self._to_int(submission)
+            except ValueError:
+                self.errors.append(
+                    (line, u'Invalid submission %s' % submission)
+                )
+                continue
+
+            try:
+                mark = self._to_int(mark)
+            except ValueError:
+                mark = None
+            if mark not in previews.MARK_WEIGHTS:
+                self.errors.append((line, u'Invalid mark %s' % row[2]))
+                continue
+
+            key = previewer_id, submission_id
+            if key in marks:
+                self.duplicates.append((line, (
+                    u'Previewer %s has marked submission %s on line %s'
+                ) % (previewer, submission_id, marks[key][1])))
+            marks[key] = mark, line
+        return marks
+
+    def run(self, rows, dry_run=False):
+        marks = self._parse(rows)
+
+        submission_ids = set(key[1] for key in marks)
+        existing_submissions = set()
+        existing_marks = {}
+        for chunk in chunks(sorted(submission_ids)):
+            existing_submissions.update(Submission.objects.filter(
+                pk__in=chunk
+            ).values_list('id', flat=True))
+            for pk, previewer_id, submission_id, mark in (
+                PreviewMark.objects.filter(submission__in=chunk).values_list(
+                    'id', 'previewer_id', 'submission_id', 'mark'
+                )
+            ):
+                existing_marks[previewer_id, submission_id] = pk, mark
+
+        to_create = []
+        to_update = defaultdict(list)
+        for key, (mark, line) in sorted(marks.items(),
+                                        key=lambda item: item[1][1]):
+            previewer_id, submission_id = key
+            if submission_id not in existing_submissions:
+                self.errors.append(
+                    (line, u'Unknown submission %s' % submission_id)
+                )
+            elif key not in existing_marks:
+                to_create.append(PreviewMark(
+                    previewer_id=previewer_id, submission_id=submission_id,
+                    mark=mark,
+                ))
+            elif existing_marks[key][1] != mark:
+                to_update[mark].append(existing_marks[key][0])
+            else:
+                self.unchanged += 1
+
+        self.errors.sort()
+        self.created = len(to_create)
+        self.updated = sum(len(pks) for pks in to_update.itervalues())
+        if self.errors or dry_run:
+            return
+
+        try:
+            self._save(to_create, to_update, submission_ids)
+        except IntegrityError:
+            # marks were added since the existing ones were read
+            self._report_conflicts(marks, to_create)
+
+    def _report_conflicts(self, marks, to_create):
+        created = set(
+            (mark.previewer_id, mark.submission_id) for mark in to_create
+        )
+        for chunk in chunks(sorted(set(key[1] for key in created))):
+            for key in PreviewMark.objects.filter(
+                submission__in=chunk
+            ).values_list('previewer_id', 'submission_id'):
+                if key in created:
+                    self.errors.append((marks[key][1], (
+                        u'Previewer %s has marked submission %s meanwhile'
+                    ) % key))
+        if not self.errors:
+            self.errors.append(
+                (self.first_line, u'Marks were changed meanwhile')
+            )
+        self.errors.sort()
+
+    @transaction.commit_on_success
+    def _save(self, to_create, to_update, submission_ids):
+        for chunk in chunks(to_create):
+            PreviewMark.objects.bulk_create(chunk)
+        for mark, pks in to_update.iteritems():
+            for chunk in chunks(pks):
+                PreviewMark.objects.filter(pk__in=chunk).update(mark=mark)
+
+        for chunk in chunks(sorted(submission_ids)):
+            Submission.update_preview_marks(
+                Submission.objects.filter(pk__in=chunk).values_list('id')
+            )
+        # marks may close assignments, recounting is cheaper than
+        # following every mark
+        recount_queue(submission_ids)
@@ -1,4 +1,5 @@
-from datetime import datetime
+from collections import defaultdict
+from datetime import datetime, timedelta
 from hashlib import md5
 
 import uuid
@@ -7,7 +8,8 @@ from django.db import models
 from django.utils.translation import ugettext_lazy as _
 from django.core.urlresolvers import reverse
 from django.conf import settings
-from django.db import transaction
+from django.utils import timezone
+from django.db import IntegrityError, connection, transaction
 
 from hvad.models import TranslatableModel, TranslatedFields
 from dirtyfields import DirtyFieldsMixin
@@ -133,6 +135,8 @@ class Submission(models.Model, DirtyFieldsMixin):
         null=True, blank=True, verbose_name=_('Papers received at'))
     vob_received_at = models.DateTimeField(
         null=True, blank=True, verbose_name=_('Vob received at'))
+    updated_at = models.DateTimeField(
+        auto_now=True, db_index=True, verbose_name=_('Updated at'))
 
     preview = models.FloatField(
         null=True, blank=True, verbose_name=_('Preview result'))
@@ -140,6 +144,11 @@ class Submission(models.Model, DirtyFieldsMixin):
         null=True, blank=True, verbose_name=_('Preview average result'))
     previewers = models.IntegerField(
         null=True, blank=True, verbose_name=_('Previewers count'))
+    # running sums of marks, see count_preview_mark()
+    preview_mark_count = models.IntegerField(default=0, editable=False)
+    preview_mark_sum = models.IntegerField(default=0, editable=False)
+    preview_weighted_sum = models.FloatField(default=0, editable=False)
+    preview_coefficient_sum = models.FloatField(default=0, editable=False)
 
     received_subtitles = models.BooleanField(default=False)
     received_screenshots = models.BooleanField(default=False)
@@ -157,18 +166,20 @@ class Submission(models.Model, DirtyFieldsMixin):
     def __repr__(self):
         return '<Film %s>' % (self.title)
 
+    FACT_DATES = {
+        'comment_email_sent': 'email_sent_at',
+        'comment_film_received': 'film_received_at',
+        'comment_papers_received': 'papers_received_at',
+        'comment_vob_received': 'vob_received_at',
+    }
+    EMAILED_FACTS = ('comment_film_received', 'comment_papers_received')
+
     def _track_facts(self):
-        facts = {
-            'comment_email_sent': 'email_sent_at',
-            'comment_film_received': 'film_received_at',
-            'comment_papers_received': 'papers_received_at',
-            'comment_vob_received': 'vob_received_at',
-        }
         dirty_fields = self.get_dirty_fields()
 
         now = datetime.now()
 
-        for comment_field, date_field in facts.iteritems():
+        for comment_field, date_field in self.FACT_DATES.iteritems():
             value = getattr(self, comment_field)
             if comment_field in dirty_fields:
                 if value == True:
@@ -182,55 +193,136 @@ class Submission(models.Model, DirtyFieldsMixin):
 
         dirty_fields = self.get_dirty_fields().copy()
         new_fact = lambda fact: getattr(self, fact) and fact in dirty_fields
+        created = self.pk is None
 
         res = super(Submission, self).save(*args, **kwargs)
 
-        countdown = 60 * 20  # 20 minutes
-        if new_fact('comment_film_received'):
-            from apps.cpm2013.tasks import SendEmailUpdate
-            SendEmailUpdate().apply_async(
-                args=[self.id, 'comment_film_received'],
-                countdown=countdown
-            )
-        if new_fact('comment_papers_received'):
-            from apps.cpm2013.tasks import SendEmailUpdate
-            SendEmailUpdate().apply_async(
-                args=[self.id, 'comment_papers_received'],
-                countdown=countdown
+        if created:
+            PreviewQueueEntry.objects.create(submission=self,
+                                             length=self.length)
+        elif 'length' in dirty_fields:
+            PreviewQueueEntry.objects.filter(submission=self).update(
+                length=self.length
             )
 
-        return res
+        from apps.cpm2013.pdf import invalidate_submission_confirmation
+        invalidate_submission_confirmation(self)
 
-    def update_preview_mark(self):
-        marks = PreviewMark.objects.filter(submission=self)
-        marks = marks.select_related('previewer')
+        new_facts = [fact for fact in self.EMAILED_FACTS if new_fact(fact)]
+        if new_facts:
+            # one email for all changes made within 20 minutes
+            PendingEmailUpdate.schedule(self.id, new_facts, countdown=60 * 20)
 
-        if len(marks) == 0:
-            return
+        return res
 
-        nonlinear = {
-            1: 1.00,
-            2: 1.75,
-            3: 2.50,
-            4: 3.50,
-            5: 5.00,
+    @staticmethod
+    def _get_preview_values(count, mark_sum, weighted_sum, coefficient_sum):
+        if not count:
+            return {
+                'preview_mark_count': 0,
+                'preview_mark_sum': 0,
+                'preview_weighted_sum': 0,
+                'preview_coefficient_sum': 0,
+                'previewers': None,
+                'preview_average': None,
+                'preview': None,
+            }
+
+        return {
+            'preview_mark_count': count,
+            'preview_mark_sum': mark_sum,
+            'preview_weighted_sum': weighted_sum,
+            'preview_coefficient_sum': coefficient_sum,
+            'previewers': count,
+            'preview_average': float(mark_sum) / count,
+            'preview': (
+                weighted_sum / coefficient_sum if coefficient_sum else None
+            ),
         }
 
-        res_avg = sum(mark.mark for mark in marks)
-        
-        res_nonlin = sum(
-            nonlinear[mark.mark]*mark.previewer.coefficient \
-            for mark in marks
+    @classmethod
+    def update_preview_marks(cls, submission_ids=None):
+        """
+        Recalculates preview results of all submissions, or of ones whose
+        ids are selected by the ``submission_ids`` queryset
+
+        Marks are weighted and summed up by the database, so it takes two
+        UPDATE queries whatever the number of submissions is.
+        """
+        qn = connection.ops.quote_name
+        tables = {
+            'submission': qn(cls._meta.db_table),
+            'mark': qn(PreviewMark._meta.db_table),
+            'previewer': qn(Previewer._meta.db_table),
+            'weight': 'CASE m.mark %s END' % ' '.join(
+                'WHEN %d THEN %r' % item
+                for item in sorted(previews.MARK_WEIGHTS.items())
+            ),
+        }
+        marks = (
+            'FROM %(mark)s m INNER JOIN %(previewer)s p '
+            'ON p.id = m.previewer_id '
+            'WHERE m.submission_id = %(submission)s.id'
+        ) % tables
+
+        where, where_params = '', []
+        if submission_ids is not None:
+            subquery, where_params = submission_ids.query.get_compiler(
+                connection=connection
+            ).as_sql()
+            where = ' WHERE id IN (%s)' % subquery
+
+        cursor = connection.cursor()
+        cursor.execute(
+            'UPDATE %(submission)s SET '
+            'preview_mark_count = (SELECT COUNT(*) %(marks)s), '
+            'preview_mark_sum = (SELECT COALESCE(SUM(m.mark), 0) %(marks)s), '
+            'preview_weighted_sum = ('
+            'SELECT COALESCE(SUM(%(weight)s * p.coefficient), 0) %(marks)s), '
+            'preview_coefficient_sum = ('
+            'SELECT COALESCE(SUM(p.coefficient), 0) %(marks)s), '
+            'updated_at = %%s' % dict(tables, marks=marks) + where,
+            [connection.ops.value_to_db_datetime(timezone.now())] +
+            list(where_params)
         )
-        div_nonlin = sum(
-            mark.previewer.coefficient \
-            for mark in marks
+        cursor.execute(
+            'UPDATE %(submission)s SET '
+            'previewers = CASE WHEN preview_mark_count > 0 '
+            'THEN preview_mark_count END, '
+            'preview_average = CASE WHEN preview_mark_count > 0 '
+            'THEN 1.0 * preview_mark_sum / preview_mark_count END, '
+            'preview = CASE WHEN preview_coefficient_sum <> 0 '
+            'THEN preview_weighted_sum / preview_coefficient_sum END'
+            % tables + where,
+            where_params
         )
 
-        self.previewers = 0.0 + len(marks)
-        self.preview_average = res_avg / self.previewers
-        self.preview = res_nonlin / div_nonlin
-        self.save()
+    @classmethod
+    def count_preview_mark(cls, submission_id, mark, coefficient, count=1):
+        """
+        Adds a mark to preview results of the submission, or removes it
+        with ``count=-1``, without reading the other marks
+        """
+        try:
+            sums = cls.objects.select_for_update().filter(
+                pk=submission_id
+            ).values_list(
+                'preview_mark_count', 'preview_mark_sum',
+                'preview_weighted_sum', 'preview_coefficient_sum',
+            ).get()
+        except cls.DoesNotExist:
+            return
+
+        mark_count, mark_sum, weighted_sum, coefficient_sum = sums
+        values = cls._get_preview_values(
+            mark_count + count,
+            mark_sum + mark * count,
+            weighted_sum + previews.MARK_WEIGHTS[mark] * coefficient * count,
+            coefficient_sum + coefficient * count,
+        )
+        cls.objects.filter(pk=submission_id).update(
+            updated_at=timezone.now(), **values
+        )
 
     def get_absolute_url(self):
         submission_hash = md5('%s%s' % (settings.SECRET_KEY, self.id))
@@ -274,10 +366,75 @@ class LetterTemplate(TranslatableModel):
 
 class ActionRegistry(models.Model):
     code = models.CharField(verbose_name=_('Action code'), max_length=100,
-                            db_index=True)
+                            unique=True)
     at = models.DateTimeField(
         auto_now_add=True, verbose_name=_('At'))
 
+    @classmethod
+    def register(cls, code):
+        """
+        Registers action, returns False if it is already registered
+        """
+        try:
+            with transaction.commit_on_success():
+                cls.objects.create(code=code)
+        except IntegrityError:
+            return False
+        return True
+
+
+class PendingEmailUpdate(models.Model):
+    """
+    Facts of a submission waiting to be reported in one email.
+
+    Every new fact postpones the email, see ``FlushEmailUpdates`` task.
+    """
+    submission = models.ForeignKey('Submission', unique=True)
+    facts = models.CharField(verbose_name=_('Facts'), max_length=255)
+    due_at = models.DateTimeField(
+        verbose_name=_('Due at'), null=True, db_index=True)
+
+    @classmethod
+    def schedule(cls, submission_id, facts, countdown):
+        due_at = timezone.now() + timedelta(seconds=countdown)
+        pending, created = cls.objects.get_or_create(
+            submission_id=submission_id,
+            defaults={'facts': ','.join(facts), 'due_at': due_at},
+        )
+        if not created:
+            merged = set(pending.get_facts()) | set(facts)
+            cls.objects.filter(pk=pending.pk).update(
+                facts=','.join(sorted(merged)), due_at=due_at
+            )
+
+    @classmethod
+    def schedule_many(cls, facts_by_submission, countdown):
+        """
+        Same as ``schedule`` for ``{submission_id: facts}`` at once
+        """
+        due_at = timezone.now() + timedelta(seconds=countdown)
+        existing = cls.objects.filter(
+            submission__in=facts_by_submission.keys()
+        )
+
+        merged_facts = defaultdict(list)
+        for pending in existing:
+            facts = facts_by_submission.pop(pending.submission_id)
+            merged = ','.join(sorted(set(pending.get_facts()) | set(facts)))
+            merged_facts[merged].append(pending.pk)
+
+        for facts, pks in merged_facts.iteritems():
+            cls.objects.filter(pk__in=pks).update(facts=facts, due_at=due_at)
+
+        cls.objects.bulk_create([
+            cls(submission_id=submission_id, facts=','.join(facts),
+                due_at=due_at)
+            for submission_id, facts in facts_by_submission.iteritems()
+        ])
+
+    def get_facts(self):
+        return self.facts.split(',')
+
 from apps.cpm2013 import previews
     
 class Previewer(models.Model):
@@ -328,21 +485,33 @@ class Previewer(models.Model):
 #        max_value=5.0,
         default=1.0,
     )
+    # runtime of films assigned to or marked by the previewer
+    preview_minutes = models.IntegerField(default=0, editable=False)
 
     marks = models.ManyToManyField(Submission, through='PreviewMark')
 
+    def __init__(self, *args, **kwargs):
+        super(Previewer, self).__init__(*args, **kwargs)
+        self._saved_coefficient = self.coefficient if self.pk else None
+
     def __unicode__(self):
         return '%s (%s)' % (self.name, self.email)
 
     @transaction.commit_on_success
-    def save(self):
-        res = super(Previewer, self).save()
+    def save(self, *args, **kwargs):
+        res = super(Previewer, self).save(*args, **kwargs)
 
-        for prev_mark in PreviewMark.objects.filter(previewer=self):
-            prev_mark.submission.update_preview_mark()
+        if self._saved_coefficient != self.coefficient:
+            Submission.update_preview_marks(
+                PreviewMark.objects.filter(
+                    previewer=self
+                ).values_list('submission_id')
+            )
+        self._saved_coefficient = self.coefficient
 
         return res
-        
+
+
 class PreviewMark(models.Model):
     previewer = models.ForeignKey(Previewer)
     submission = models.ForeignKey(Submission)
@@ -350,16 +519,83 @@ class PreviewMark(models.Model):
         choices=[(n, str(n)) for n in xrange(1, 6)]
     )
 
+    def __init__(self, *args, **kwargs):
+        super(PreviewMark, self).__init__(*args, **kwargs)
+        self._counted = self._get_counted() if self.pk else None
+
+    def _get_counted(self):
+        return self.submission_id, self.previewer_id, self.mark
+
+    def _count(self, counted, count):
+        submission_id, previewer_id, mark = counted
+        coefficient = Previewer.objects.filter(
+            pk=previewer_id
+        ).values_list('coefficient', flat=True).get()
+        Submission.count_preview_mark(
+            submission_id, mark, coefficient, count=count
+        )
+
+    def _queue(self, counted, count):
+        from apps.cpm2013.assignments import count_watched
+
+        submission_id, previewer_id, mark = counted
+        count_watched(previewer_id, submission_id, count=count)
+
     @transaction.commit_on_success
-    def save(self):
-        res = super(PreviewMark, self).save()
+    def save(self, *args, **kwargs):
+        res = super(PreviewMark, self).save(*args, **kwargs)
+
+        counted = self._get_counted()
+        if counted != self._counted:
+            if self._counted is not None:
+                self._count(self._counted, -1)
+            self._count(counted, 1)
 
-        self.submission.update_preview_mark()
+            # a changed mark is still the same watched film
+            if self._counted is None or self._counted[:2] != counted[:2]:
+                if self._counted is not None:
+                    self._queue(self._counted, -1)
+                self._queue(counted, 1)
+            self._counted = counted
 
         return res
 
-#    class Meta:
-#        unique_together = ['previewer', 'submission']
+    @transaction.commit_on_success
+    def delete(self, *args, **kwargs):
+        if self._counted is not None:
+            self._count(self._counted, -1)
+            self._queue(self._counted, -1)
+            self._counted = None
+
+        return super(PreviewMark, self).delete(*args, **kwargs)
+
+    class Meta:
+        unique_together = ['previewer', 'submission']
+
+
+class PreviewQueueEntry(models.Model):
+    """
+    Submission waiting to be previewed, see ``apps.cpm2013.assignments``.
+
+    ``coverage`` counts marks and open assignments of the film. The table
+    has an index on ``(coverage, length)``, so the next film is found by
+    an index lookup, not by counting marks.
+    """
+    submission = models.ForeignKey(Submission, unique=True)
+    coverage = models.IntegerField(default=0)
+    length = models.IntegerField()
+
+
+class PreviewAssignment(models.Model):
+    """
+    Film given to a previewer and not marked yet
+    """
+    previewer = models.ForeignKey(Previewer)
+    submission = models.ForeignKey(Submission)
+    assigned_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        unique_together = ['previewer', 'submission']
 
 
 class SubmissionFileUpload(models.Model):
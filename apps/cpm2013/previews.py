@@ -98,3 +98,13 @@ class CINEPHILIA_STAGE:
     )
 
     DEFAULT = CINEMALOVER
+
+
+# nonlinear scale of marks used for preview results
+MARK_WEIGHTS = {
+    1: 1.00,
+    2: 1.75,
+    3: 2.50,
+    4: 3.50,
+    5: 5.00,
+}
@@ -0,0 +1,175 @@
+from collections import namedtuple
+
+from django.db import connection
+from django.utils.translation import ugettext_lazy as _
+
+from apps.cpm2013.models import Previewer, PreviewMark, Submission
+
+
+METHOD_CHOICES = (
+    ('zscore', _('Z-score')),
+    ('quantile', _('Quantile')),
+)
+
+# two-sided 95% interval of the normal distribution
+CONFIDENCE_Z = 1.96
+
+RankedSubmission = namedtuple(
+    'RankedSubmission', 'id section rank score low high marks'
+)
+
+
+class MarkMatrix(object):
+    """
+    Marks of previewers on submissions kept as NumPy arrays.
+
+    Every previewer sees a small share of the films, so the matrix is
+    stored by its non-empty cells: ``previewers``, ``submissions`` and
+    ``marks`` arrays of equal length, where the first two are row and
+    column indexes into ``previewer_ids`` and ``submission_ids``.
+
+    NumPy is an optional dependency and is imported on ``load()``.
+    """
+    def __init__(self, previewer_ids, coefficients, submission_ids,
+                 sections, previewers, submissions, marks):
+        self.previewer_ids = previewer_ids
+        self.coefficients = coefficients
+        self.submission_ids = submission_ids
+        self.sections = sections
+        self.previewers = previewers
+        self.submissions = submissions
+        self.marks = marks
+
+    @classmethod
+    def load(cls):
+        import numpy as np
+
+        def fetch(queryset, dtype):
+            # rows go to numpy straight from the cursor, model instances
+            # and values() dicts cost more than the ranking itself
+            cursor = connection.cursor()
+            cursor.execute(*queryset.query.sql_with_params())
+            return np.array(cursor.fetchall(), dtype=dtype)
+
+        marks = fetch(PreviewMark.objects.values_list(
+            'previewer_id', 'submission_id', 'mark'
+        ), np.int64).reshape(-1, 3)
+        previewers = fetch(Previewer.objects.order_by('id').values_list(
+            'id', 'coefficient'
+        ), np.float64).reshape(-1, 2)
+        submissions = fetch(Submission.objects.order_by('id').values_list(
+            'id', 'section'
+        ), np.int64).reshape(-1, 2)
+
+        submission_ids, submission_index = np.unique(
+            marks[:, 1], return_inverse=True
+        )
+        sections = submissions[
+            np.searchsorted(submissions[:, 0], submission_ids), 1
+        ]
+
+        previewer_ids, previewer_index = np.unique(
+            marks[:, 0], return_inverse=True
+        )
+        coefficients = previewers[
+            np.searchsorted(previewers[:, 0], previewer_ids), 1
+        ]
+
+        return cls(previewer_ids, coefficients, submission_ids, sections,
+                   previewer_index, submission_index,
+                   marks[:, 2].astype(np.float64))
+
+    def _zscores(self):
+        import numpy as np
+
+        count = np.bincount(self.previewers,
+                            minlength=len(self.previewer_ids))
+        mean = np.bincount(self.previewers, weights=self.marks) / count
+        deviation = self.marks - mean[self.previewers]
+        std = np.sqrt(
+            np.bincount(self.previewers, weights=deviation ** 2) / count
+        )
+        # previewers who give every film the same mark tell nothing about
+        # the films beyond their own average
+        std[std == 0] = np.inf
+        return deviation / std[self.previewers]
+
+    def _quantiles(self):
+        import numpy as np
+
+        # marks are small integers, so the distribution of every previewer
+        # is a row of counts per mark
+        values = self.marks.astype(np.int64)
+        histogram = np.zeros((len(self.previewer_ids), values.max() + 1))
+        np.add.at(histogram, (self.previewers, values), 1)
+
+        below = np.cumsum(histogram, axis=1) - histogram
+        count = histogram.sum(axis=1)
+        return (
+            below[self.previewers, values] +
+            histogram[self.previewers, values] / 2
+        ) / count[self.previewers] - 0.5
+
+    def normalize(self, method):
+        """
+        Returns marks brought to the scale of every previewer
+        """
+        if method == 'zscore':
+            return self._zscores()
+        if method == 'quantile':
+            return self._quantiles()
+        raise ValueError('Unknown method %s' % method)
+
+    def rank(self, method='zscore'):
+        """
+        Returns ``RankedSubmission`` list ordered by section and rank
+
+        The score is the mean of normalized marks weighted by previewer
+        coefficients, ``low`` and ``high`` are bounds of its 95%
+        confidence interval.
+        """
+        import numpy as np
+
+        if not len(self.marks):
+            return []
+
+        scores = self.normalize(method)
+        weights = self.coefficients[self.previewers]
+        size = len(self.submission_ids)
+
+        count = np.bincount(self.submissions, minlength=size)
+        weight_sum = np.bincount(self.submissions, weights=weights,
+                                 minlength=size)
+        weight_sum[weight_sum == 0] = np.inf
+        mean = np.bincount(self.submissions, weights=weights * scores,
+                           minlength=size) / weight_sum
+
+        variance = np.bincount(
+            self.submissions,
+            weights=weights * (scores - mean[self.submissions]) ** 2,
+            minlength=size,
+        ) / weight_sum
+        effective_count = weight_sum ** 2 / np.bincount(
+            self.submissions, weights=weights ** 2, minlength=size
+        )
+        # a film with a single mark gets the spread of all marks
+        variance[count < 2] = scores.var()
+        effective_count[~np.isfinite(effective_count)] = 1
+        error = CONFIDENCE_Z * np.sqrt(variance / effective_count)
+
+        order = np.lexsort((self.submission_ids, -mean, self.sections))
+        sections = self.sections[order]
+        section_starts = np.searchsorted(sections, sections)
+        ranks = np.arange(size) - section_starts + 1
+
+        return [
+            RankedSubmission(*values) for values in zip(
+                self.submission_ids[order].tolist(),
+                sections.tolist(),
+                ranks.tolist(),
+                mean[order].tolist(),
+                (mean - error)[order].tolist(),
+                (mean + error)[order].tolist(),
+                count[order].tolist(),
+            )
+        ]
@@ -1,20 +1,31 @@
 import logging
+from datetime import timedelta
 
 from django.conf import settings
 from django.core.mail import EmailMessage
-from django.utils import translation
+from django.utils import timezone, translation
 from django.template import loader
 
-from apps.cpm2013.models import Submission, LetterTemplate, ActionRegistry
+from apps.cpm2013.models import (
+    Submission, LetterTemplate, ActionRegistry, PendingEmailUpdate
+)
+from apps.cpm_common.mail import queue_email
+from apps.cpm2013.assignments import expire_assignments
+from apps.cpm2013.pdf import get_submission_confirmation_pdf, renderer
 from celery import Task
+from celery.signals import worker_process_init
 
 logger = logging.getLogger('cpm2013.tasks')
 
 
+@worker_process_init.connect
+def warm_pdf_renderer(**kwargs):
+    renderer.warm()
+
+
 class SendSubmissionEmail(Task):
     def create_pdf(self, submission):
-        from apps.cpm2013.pdf import get_submission_confirmation_report
-        return get_submission_confirmation_report(submission)
+        return get_submission_confirmation_pdf(submission)
 
     def get_email_message(self, submission):
         lang = translation.get_language().lower()
@@ -25,11 +36,25 @@ class SendSubmissionEmail(Task):
             }
         )
         
-    def run(self, submission):
-        logger.info('SendSubmissionEmail for submission %s' % (
-            submission.id
-        ))
+    def run(self, submission_id):
+        logger.info('SendSubmissionEmail for submission %s' % submission_id)
+
+        # the flag is the dedup key, a retried or repeated call finds it set
+        claimed = Submission.objects.filter(
+            pk=submission_id, comment_email_sent=False
+        ).update(
+            comment_email_sent=True,
+            email_sent_at=timezone.now(),
+            updated_at=timezone.now(),
+        )
+        if not claimed:
+            logger.info('SendSubmissionEmail: %s is already sent' % (
+                submission_id
+            ))
+            return
+
         try:
+            submission = Submission.objects.get(pk=submission_id)
             translation.activate(submission.submission_language)
 
             email = EmailMessage(
@@ -44,82 +69,170 @@ class SendSubmissionEmail(Task):
                 'cpm2013.pdf', self.create_pdf(submission), 'application/pdf'
             )
 
-            email.send()
+            queue_email(email)
         except:
             logger.exception('')
+            Submission.objects.filter(pk=submission_id).update(
+                comment_email_sent=False,
+                email_sent_at=None,
+                updated_at=timezone.now(),
+            )
             raise
         finally:
             translation.deactivate()
-            try:
-                submission = Submission.objects.get(pk=submission.pk)
-            except Submission.DoesNotExist:
-                logger.exception('Failed to update "email sent" status')
-            else:
-                submission.comment_email_sent = True
-                submission.save()
+
+
+class RenderSubmissionPdf(Task):
+    def run(self, submission_id):
+        logger.info('RenderSubmissionPdf for submission %s' % submission_id)
+
+        submission = Submission.objects.get(pk=submission_id)
+        try:
+            translation.activate(submission.submission_language)
+            get_submission_confirmation_pdf(submission)
+        finally:
+            translation.deactivate()
 
 
 
 class SendEmailFromTemplate(Task):
-    def run(self, submission, template_code):
-        logger.info('SendEmailFromTemplate:%d template %s' % (
-                submission.id, template_code
+    def send(self, submission, template_codes):
+        """
+        Sends letters of ``template_codes`` joined into one email
+        """
+        logger.info('SendEmailFromTemplate:%d templates %s' % (
+                submission.id, ', '.join(template_codes)
         ))
         
         try:
             translation.activate(submission.submission_language)
 
-            letter = LetterTemplate.objects.language().get(code=template_code)
+            letters = dict(
+                (letter.code, letter) for letter in
+                LetterTemplate.objects.language().filter(
+                    code__in=template_codes
+                )
+            )
+            letters = [letters[code] for code in template_codes]
             email = EmailMessage(
-                letter.subject,
-                letter.text % {'name': submission.applicant},
+                '; '.join(letter.subject for letter in letters),
+                '\n\n'.join(
+                    letter.text % {'name': submission.applicant}
+                    for letter in letters
+                ),
                 'no-reply@filmfest.by',
                 [submission.applicant_email],
                 list(settings.MAIL_BCC_LIST),
                 headers = {'Reply-To': '2013@filmfest.by'}
             )
-            email.send()
+            queue_email(email)
         except:
-            logger.info('SendEmailFromTemplate:%d template %s exception' % (
-                submission.id, template_code
+            logger.info('SendEmailFromTemplate:%d templates %s exception' % (
+                submission.id, ', '.join(template_codes)
             ))
             raise
         finally:
             translation.deactivate()
-        logger.info('SendEmailFromTemplate:%d template %s done' % (
-            submission.id, template_code
+        logger.info('SendEmailFromTemplate:%d templates %s done' % (
+            submission.id, ', '.join(template_codes)
         ))
 
+    def run(self, submission_id, template_code):
+        self.send(Submission.objects.get(id=submission_id), [template_code])
 
-class SendEmailUpdate(Task):
-    def run(self, submission_id, fact_name):
-        logger.info('SendEmailUpdate:%d fact %s' % (submission_id, fact_name))
-
-        submission = Submission.objects.get(id=submission_id)
-        fact = getattr(submission, fact_name)
-        if not fact:
-            logger.info('SendEmailUpdate:%d False' % submission_id)
-            return
 
+class SendEmailUpdate(Task):
+    def get_template_code(self, submission, fact_name):
         if fact_name == 'comment_film_received':
             if submission.comment_vob_received:
-                template_code = 'film_received_vob'
-            else:
-                template_code = 'film_received'
+                return 'film_received_vob'
+            return 'film_received'
         elif fact_name == 'comment_papers_received':
-            template_code = 'papers_received'
-        else:
-            logger.error('SendEmailUpdate:%d unknown fact' % submission_id)
+            return 'papers_received'
+
+    def send(self, submission, fact_names):
+        """
+        Sends one email about the facts which are set and not reported yet
+        """
+        template_codes = []
+        action_codes = []
+        for fact_name in fact_names:
+            if not getattr(submission, fact_name):
+                logger.info('SendEmailUpdate:%d %s False' % (
+                    submission.id, fact_name
+                ))
+                continue
+
+            template_code = self.get_template_code(submission, fact_name)
+            if template_code is None:
+                logger.error('SendEmailUpdate:%d unknown fact %s' % (
+                    submission.id, fact_name
+                ))
+                continue
+
+            action_code = 'submission:%s:%s' % (submission.id, fact_name)
+            if not ActionRegistry.register(action_code):
+                logger.error('SendEmailUpdate:%d registered fact %s' % (
+                    submission.id, fact_name
+                ))
+                continue
+
+            template_codes.append(template_code)
+            action_codes.append(action_code)
+
+        if not template_codes:
             return
 
-        action_code = 'submission:%s:%s' % (submission_id, fact_name)
-        if ActionRegistry.objects.filter(code=action_code).count() > 0:
-            logger.error('SendEmailUpdate:%d registered fact %s' % (
-                submission_id, fact_name
-            ))
-            return
+        try:
+            SendEmailFromTemplate().send(submission, template_codes)
+        except:
+            # let a retry send it
+            ActionRegistry.objects.filter(code__in=action_codes).delete()
+            raise
 
-        SendEmailFromTemplate().run(submission, template_code)
-        ActionRegistry(code=action_code).save()
+        logger.info('SendEmailUpdate:%d done' % submission.id)
 
-        logger.info('SendEmailUpdate:%d done' % submission_id)
+    def run(self, submission_id, fact_name):
+        logger.info('SendEmailUpdate:%d fact %s' % (submission_id, fact_name))
+        self.send(Submission.objects.get(id=submission_id), [fact_name])
+
+
+class FlushEmailUpdates(Task):
+    """
+    Sends email updates which are not postponed by newer facts anymore
+    """
+    def run(self):
+        due = PendingEmailUpdate.objects.filter(due_at__lte=timezone.now())
+        for pending in due.select_related('submission'):
+            # a cleared due date marks the update as being sent
+            claimed = PendingEmailUpdate.objects.filter(
+                pk=pending.pk, due_at=pending.due_at
+            ).update(due_at=None)
+            if not claimed:
+                continue
+
+            try:
+                SendEmailUpdate().send(pending.submission, pending.get_facts())
+            except Exception:
+                logger.exception('FlushEmailUpdates:%d failed' % (
+                    pending.submission_id
+                ))
+                PendingEmailUpdate.objects.filter(
+                    pk=pending.pk, due_at=None
+                ).update(due_at=timezone.now() + timedelta(minutes=20))
+                continue
+
+            # facts added while sending have set a new due date
+            PendingEmailUpdate.objects.filter(
+                pk=pending.pk, due_at=None
+            ).delete()
+
+
+class ExpirePreviewAssignments(Task):
+    """
+    Gives films of forgotten assignments back to the preview queue
+    """
+    def run(self):
+        expired = expire_assignments()
+        if expired:
+            logger.info('ExpirePreviewAssignments: %d expired' % expired)
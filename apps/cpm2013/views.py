@@ -14,11 +14,18 @@ from django.core.urlresolvers import reverse
 from django.core.mail import mail_managers
 from django.conf import settings
 
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
 from apps.cpm2013.constants import APP_ROOT
 from apps.cpm2013.models import Submission, NewsEntry, Page,\
-     SubmissionFileUpload
+     SubmissionFileUpload, Previewer
+from apps.cpm2013.assignments import assign_next
 from apps.cpm2013.forms import SubmissionForm, FileUploadForm
+from apps.cpm2013.marks import MARK_COLUMNS, MarkImport
 from apps.cpm2013.tasks import SendSubmissionEmail
+from apps.cpm_common.translations import get_translation_resolver
 
 
 def index(request):
@@ -40,7 +47,7 @@ def submit(request):
         submission.submission_language = translation.get_language()
         submission.save()
 
-        SendSubmissionEmail().apply_async(args=[submission])
+        SendSubmissionEmail().apply_async(args=[submission.id])
         
         return render_to_response(
             'cpm2013/submit_done.html',
@@ -56,17 +63,11 @@ def submit(request):
 
 def page(request, slug):
     base_page = get_object_or_404(Page, slug=slug)
-    pages = base_page._meta.translations_model.objects.filter(master=base_page)
-    pages = dict((t.language_code, t) for t in pages)
-
-    current_lang = translation.get_language()
-    if current_lang in pages:
-        page = pages[current_lang]
-    else:
-        for lang_code in ['en', 'ru', 'be']:
-            if lang_code in pages:
-                page = pages[lang_code]
-                break
+    page = get_translation_resolver(request).resolve(
+        [base_page], Page._meta.translations_model, 'master', 'language_code'
+    )[base_page.pk]
+    if page is None:
+        raise Http404
 
     return render_to_response(
         'cpm2013/page.html',
@@ -329,3 +330,67 @@ def program(request, program_id):
         },
         context_instance=RequestContext(request),
     )
+
+
+class PreviewMarksView(APIView):
+    """
+    Saves preview marks posted as a list of
+    ``{"previewer": id or email, "submission": id, "mark": 1-5}`` objects.
+
+    Nothing is saved if any mark is invalid, ``?dry_run=1`` only checks
+    the marks. Lines in the report are indexes in the list.
+    """
+    def post(self, request):
+        marks = request.DATA
+        if not (isinstance(marks, list) and
+                all(isinstance(mark, dict) for mark in marks)):
+            return Response(
+                {'detail': 'Expected a list of marks'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        mark_import = MarkImport(first_line=0)
+        mark_import.run(
+            ([mark.get(name) for name in MARK_COLUMNS] for mark in marks),
+            dry_run=request.QUERY_PARAMS.get('dry_run', '').lower() in (
+                '1', 'true', 'yes'
+            ),
+        )
+
+        report = {
+            'created': mark_import.created,
+            'updated': mark_import.updated,
+            'unchanged': mark_import.unchanged,
+            'errors': [
+                {'line': line, 'message': message}
+                for line, message in mark_import.errors
+            ],
+            'duplicates': [
+                {'line': line, 'message': message}
+                for line, message in mark_import.duplicates
+            ],
+        }
+        if mark_import.errors:
+            return Response(report, status=status.HTTP_400_BAD_REQUEST)
+        return Response(report)
+preview_marks = PreviewMarksView.as_view()
+
+
+class NextPreviewView(APIView):
+    """
+    Assigns the previewer the next film to watch, answers 204 when there
+    is nothing left
+    """
+    def post(self, request, previewer_id):
+        previewer = get_object_or_404(Previewer, pk=previewer_id)
+        submission = assign_next(previewer)
+        if submission is None:
+            return Response(status=status.HTTP_204_NO_CONTENT)
+
+        return Response({
+            'submission': submission.id,
+            'title': submission.title,
+            'length': submission.length,
+            'film_link': submission.film_link,
+        }, status=status.HTTP_201_CREATED)
+next_preview = NextPreviewView.as_view()
@@ -33,9 +33,13 @@ def get_urls():
             views.translation_edit, name='translation_edit'),
         url(r'^translations/$',
             views.translations_all_json, name='translations_all_json'),
+        url(r'^translations/export/$',
+            views.translations_export, name='translations_export'),
 
         url(r'^program/list/$',
             views.program_list, name='program_list'),
+        url(r'^program/export/$',
+            views.program_export, name='program_export'),
         url(r'^program/add/$',
             views.program_edit, name='program_add'),
         url(r'^program/(?P<program_id>\d+)/$',
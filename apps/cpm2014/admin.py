@@ -1,9 +1,9 @@
+from collections import defaultdict
 from functools import update_wrapper
 from itertools import chain, islice
 import json
 import os
 import os.path
-import tempfile
 
 from django.conf import settings
 from django.contrib import admin
@@ -18,8 +18,10 @@ from django.template.defaultfilters import urlizetrunc
 from django.template import RequestContext
 from django.core.exceptions import PermissionDenied
 from django.contrib.admin.util import unquote
+from django.contrib.admin.views.main import ChangeList
 from django.db import transaction
 from django.core.urlresolvers import reverse
+from django.core.servers.basehttp import FileWrapper
 
 from hvad.admin import TranslatableAdmin
 from hvad.utils import get_translation_aware_manager
@@ -28,10 +30,14 @@ import openpyxl
 
 from apps.cpm2014 import constants
 from apps.cpm2014.models import (
-    Submission, Prescreening, NewsEntry,
+    Submission, SubmissionTranslation, Prescreening, NewsEntry,
     City, Place, Event
 )
-from apps.cpm2014.forms import FieldsForm
+from apps.cpm2014.exports import SubmissionExport, SubmissionImport
+from apps.cpm2014.forms import FieldsForm, ImportForm
+from apps.cpm_common.export import get_text_response, iter_xlsx_rows
+from apps.cpm_common.jobs import start_export
+from apps.cpm_common.translations import prefetch_translations
 
 
 class PreviewFilter(admin.SimpleListFilter):
@@ -52,12 +58,42 @@ class PreviewFilter(admin.SimpleListFilter):
             return queryset.exclude(preview=None)
 
 
+class SubmissionChangeList(ChangeList):
+    """
+    Leaves long texts out of the page and loads translation languages
+    of its submissions with one query
+    """
+    deferred_fields = ['synopsis', 'film_awards', 'director_awards',
+                       'director_address', 'producer_address',
+                       'applicant_address', 'other_credits']
+
+    def get_results(self, request):
+        # actions take the query set as is, only the page is deferred
+        query_set = self.query_set
+        self.query_set = query_set.defer(*self.deferred_fields)
+        try:
+            super(SubmissionChangeList, self).get_results(request)
+        finally:
+            self.query_set = query_set
+
+        self.result_list = list(self.result_list)
+        languages = defaultdict(set)
+        for submission_id, language in SubmissionTranslation.objects.filter(
+            submission__in=[obj.pk for obj in self.result_list]
+        ).values_list('submission', 'language'):
+            languages[submission_id].add(language)
+
+        for obj in self.result_list:
+            obj.translation_languages = languages[obj.pk]
+
+
 class SubmissionAdmin(admin.ModelAdmin):
     list_display = ['title', 'applicant_email', 'display_film_link',
                     'submitted_at', 'display_country',
                     'display_facts', 'display_comment',
                     'display_extra_data', 'display_translation']
     save_on_top = True
+    actions = ['export_pdf_zip']
 
     fieldsets = [
             (_('Comments'), {
@@ -110,9 +146,22 @@ class SubmissionAdmin(admin.ModelAdmin):
     def queryset(self, request):
         qs = Submission.objects.all().order_by('-id')
         qs = qs.annotate(num_prescreenings=Count('prescreening'))
-        qs = qs.prefetch_related('submissiontranslation_set')
         return qs
 
+    def get_changelist(self, request, **kwargs):
+        return SubmissionChangeList
+
+    def get_list_display(self, request):
+        # these columns are rendered by functions that look up labels
+        # and urls once per request rather than once per row
+        columns = {
+            'display_country': self.get_country_column(),
+            'display_facts': self.get_facts_column(),
+            'display_extra_data': self.get_extra_data_column(),
+            'display_translation': self.get_translation_column(),
+        }
+        return [columns.get(name, name) for name in self.list_display]
+
     def get_urls(self):
         from django.conf.urls import patterns, url
 
@@ -130,6 +179,9 @@ class SubmissionAdmin(admin.ModelAdmin):
             url(r'^xlsx/$',
                 wrap(self.xlsx_view),
                 name='%s_%s_xlsx' % info),
+            url(r'^xlsx_upload/$',
+                wrap(self.xlsx_upload_view),
+                name='%s_%s_xlsx_upload' % info),
         ) + super(SubmissionAdmin, self).get_urls()
 
     def display_film_link(self, obj):
@@ -148,78 +200,160 @@ class SubmissionAdmin(admin.ModelAdmin):
         return obj.get_country_display()
     display_country.short_description = _('Country')
 
-    def display_extra_data(self, obj):
-        if not obj.extra_data:
-            return ''
+    def get_country_column(self):
+        # get_country_display() builds a dict of all countries every call
+        countries = dict(
+            (code, unicode(name))
+            for code, name in Submission._meta.get_field('country').flatchoices
+        )
 
-        try:
-            return linebreaksbr(
-                json.dumps(json.loads(obj.extra_data), indent=0)
-            )
-        except ValueError:
-            return 'error'
+        def display_country(obj):
+            return countries.get(obj.country, obj.country)
+        display_country.short_description = _('Country')
+        return display_country
+
+    def display_extra_data(self, obj):
+        return self.get_extra_data_column()(obj)
     display_extra_data.short_description = _('Extra data')
     display_extra_data.allow_tags = True
 
-    def display_translation(self, obj):
-        langs_set = {
-            translation.language for translation in \
-            obj.submissiontranslation_set.all()
-        }
+    def get_extra_data_column(self):
+        encoder = json.JSONEncoder(indent=0)
 
-        def get_links():
-            for lang_code, _lang_name in constants.TRANSLATION_LANGUAGES:
-                url = reverse('cpm2014:translation_details',
-                              args=[obj.id, lang_code])
+        def display_extra_data(obj):
+            if not obj.extra_data:
+                return ''
 
-                html = '<a href="%s">%s</a>' % (url, lang_code)
-                if lang_code in langs_set:
-                    yield html
-                else:
-                    yield '<strike>%s</strike>' % html
+            try:
+                return linebreaksbr(encoder.encode(json.loads(obj.extra_data)))
+            except ValueError:
+                return 'error'
+        display_extra_data.short_description = _('Extra data')
+        display_extra_data.allow_tags = True
+        return display_extra_data
 
-        return ' '.join(get_links())
+    def display_translation(self, obj):
+        return self.get_translation_column()(obj)
     display_translation.short_description = _(u'Translation')
     display_translation.allow_tags = True
 
+    def get_translation_column(self):
+        # urls differ in the submission id only, so they are reversed
+        # with a stand-in id once and completed for every row
+        stand_in = 999999999
+        links = []
+        for lang_code, _lang_name in constants.TRANSLATION_LANGUAGES:
+            url = reverse('cpm2014:translation_details',
+                          args=[stand_in, lang_code])
+            head, tail = url.split(str(stand_in))
+            links.append((lang_code, head, tail))
+
+        def display_translation(obj):
+            langs_set = getattr(obj, 'translation_languages', None)
+            if langs_set is None:
+                langs_set = set(obj.submissiontranslation_set.values_list(
+                    'language', flat=True
+                ))
+
+            def get_links():
+                for lang_code, head, tail in links:
+                    html = '<a href="%s%d%s">%s</a>' % (
+                        head, obj.id, tail, lang_code
+                    )
+                    if lang_code in langs_set:
+                        yield html
+                    else:
+                        yield '<strike>%s</strike>' % html
+
+            return ' '.join(get_links())
+        display_translation.short_description = _(u'Translation')
+        display_translation.allow_tags = True
+        return display_translation
+
     def display_facts(self, obj):
+        return self.get_facts_column()(obj)
+    display_facts.short_description = _('Facts')
+    display_facts.allow_tags = True
+
+    def get_facts_column(self):
         fields = ['comment_email_sent', 'comment_film_received',
                   'comment_papers_received', 'comment_vob_received']
+        labels = [
+            (name, unicode(Submission._meta.get_field(name).verbose_name))
+            for name in fields
+        ]
+        prescreenings_label = unicode(_('Prescreenings'))
 
         true_html = '<img alt="True" src="/static/admin/img/icon-yes.gif">'
         false_html = '<img alt="False" src="/static/admin/img/icon-no.gif">'
-        result = []
-        for field_name in fields:
+
+        def display_facts(obj):
+            result = [
+                u'%s: %s' % (label, getattr(obj, name) and true_html or
+                                    false_html)
+                for name, label in labels
+            ]
             result.append(u'%s: %s' % (
-                obj._meta.get_field_by_name(field_name)[0].verbose_name,
-                getattr(obj, field_name) and true_html or false_html
+                prescreenings_label,
+                obj.num_prescreenings and true_html or false_html
             ))
-        result.append(u'%s: %s' % (
-            _('Prescreenings'),
-            obj.num_prescreenings and true_html or false_html
-        ))
-        return '<br />'.join(result)
-    display_facts.short_description = _('Facts')
-    display_facts.allow_tags = True
+            return '<br />'.join(result)
+        display_facts.short_description = _('Facts')
+        display_facts.allow_tags = True
+        return display_facts
 
     def pdf_view(self, request, object_id):
         obj = get_object_or_404(Submission, pk=unquote(object_id))
         if not self.has_change_permission(request, obj):
             raise PermissionDenied
 
-        from apps.cpm2013.pdf import get_submission_confirmation_report
+        from apps.cpm2014.pdf import open_submission_confirmation
+        from apps.cpm2014.tasks import RenderSubmissionPdf
 
         current_lang = translation.get_language()
         try:
             translation.activate(obj.submission_language)
-            pdf = get_submission_confirmation_report(obj)
+            pdf_file = open_submission_confirmation(obj)
         finally:
             translation.activate(current_lang)
 
-        response = HttpResponse(pdf, content_type='application/pdf')
-        response['Content-Disposition'] = 'attachment; filename="cpm2013.pdf"'
+        if pdf_file is not None:
+            response = HttpResponse(
+                FileWrapper(pdf_file), content_type='application/pdf'
+            )
+            response['Content-Length'] = os.fstat(pdf_file.fileno()).st_size
+            response['Content-Disposition'] = 'attachment; '\
+                               'filename="cpm2014.pdf"'
+            return response
+
+        # rendering takes seconds, so it is done by celery while the
+        # status page below reloads itself until the file gets into cache
+        task_id = request.GET.get('task')
+        if task_id is not None:
+            result = RenderSubmissionPdf().AsyncResult(task_id)
+            if result.successful():
+                # rendered, but the submission was changed since then
+                task_id = None
+
+        if task_id is None:
+            result = RenderSubmissionPdf().apply_async(args=[obj.id])
+            return redirect('%s?task=%s' % (request.path, result.id))
+
+        return render_to_response(
+            'admin/cpm2014/submission/pdf_status.html',
+            {'submission': obj, 'result': result},
+            context_instance=RequestContext(request),
+        )
 
-        return response
+    def export_pdf_zip(self, request, queryset):
+        # rendering takes seconds per film, so the archive is built by
+        # celery while the status page polls its progress
+        job = start_export(
+            'apps.cpm2014.exports.SubmissionConfirmationsExport',
+            {'ids': list(queryset.values_list('id', flat=True))}
+        )
+        return redirect('export_status', job.id)
+    export_pdf_zip.short_description = _('Download PDF confirmations (ZIP)')
 
     def xlsx_view(self, request):
         if not self.has_change_permission(request):
@@ -227,42 +361,16 @@ class SubmissionAdmin(admin.ModelAdmin):
 
         form = FieldsForm(request.POST or None)
         if request.method == 'POST' and form.is_valid():
-            xlsx_file = tempfile.mktemp()
-            current_lang = translation.get_language()
+            params = {'fields': form.cleaned_data['fields']}
+            if form.cleaned_data['format'] != 'xlsx':
+                return get_text_response(
+                    SubmissionExport(params).iter_rows(),
+                    form.cleaned_data['format'], 'submissions',
+                    compress=form.cleaned_data['compress'],
+                )
 
-            try:
-                submissions = Submission.objects.all().order_by('id')
-
-                translation.activate('en')
-
-                from openpyxl import Workbook
-                wb = Workbook(optimized_write = True)
-                ws = wb.create_sheet()
-
-                ws.append(form.cleaned_data['fields'])
-                for s in submissions:
-                    row = []
-                    for field in form.cleaned_data['fields']:
-                        try:
-                            row.append(getattr(s, 'get_%s_display' % field)())
-                        except AttributeError:
-                            row.append(getattr(s, field))
-                    ws.append(row)
-                wb.save(xlsx_file)
-                with open(xlsx_file, 'r') as f:
-                    xlsx = f.read()
-            finally:
-                translation.activate(current_lang)
-                if os.path.exists(xlsx_file):
-                    os.unlink(xlsx_file)
-            response = HttpResponse(
-                xlsx,
-                content_type='application/vnd.openxmlformats-officedocument.'\
-                'spreadsheetml.sheet'
-            )
-            response['Content-Disposition'] = 'attachment; '\
-                               'filename="submissions.xlsx"'
-            return response
+            job = start_export('apps.cpm2014.exports.SubmissionExport', params)
+            return redirect('export_status', job.id)
 
         return render_to_response(
             'admin/cpm2013/submission/xlsx.html',
@@ -270,12 +378,68 @@ class SubmissionAdmin(admin.ModelAdmin):
             context_instance=RequestContext(request),
         )
 
+    @transaction.commit_manually
+    def xlsx_upload_view(self, request):
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        error = ''
+        changes = None
+
+        form = ImportForm(request.POST or None, request.FILES or None)
+        if request.method == 'POST' and form.is_valid():
+            dry_run = form.cleaned_data['dry_run']
+
+            try:
+                rows = iter_xlsx_rows(form.cleaned_data['file'])
+                submission_import = SubmissionImport(next(rows, []))
+                changes = submission_import.run(rows, dry_run=dry_run)
+            except Exception as e:
+                error = unicode(e)
+                transaction.rollback()
+            else:
+                if dry_run:
+                    transaction.rollback()
+                else:
+                    transaction.commit()
+                    error = 'done'
+
+        return render_to_response(
+            'admin/cpm2013/submission/xlsx_upload.html',
+            {
+                'form': form,
+                'error': error,
+                'changes': changes,
+                'imported': changes is not None,
+            },
+            context_instance=RequestContext(request),
+        )
+
 
 class PrescreeningAdmin(admin.ModelAdmin):
     list_display = ['id', 'datetime']
     filter_horizontal = ['submissions']
 
-class NewsAdmin(TranslatableAdmin):
+class TranslationPrefetchChangeList(ChangeList):
+    """
+    Loads translations of the page and of objects it refers to through
+    ``prefetch_translations`` of the admin with a few queries
+    """
+    def get_results(self, request):
+        super(TranslationPrefetchChangeList, self).get_results(request)
+        self.result_list = prefetch_translations(
+            self.result_list, *self.model_admin.prefetch_translations
+        )
+
+
+class PrefetchingTranslatableAdmin(TranslatableAdmin):
+    # foreign key paths to translated objects shown in the changelist
+    prefetch_translations = []
+
+    def get_changelist(self, request, **kwargs):
+        return TranslationPrefetchChangeList
+
+
+class NewsAdmin(PrefetchingTranslatableAdmin):
     list_display = ['display_title', 'added_at']
 
     def queryset(self, request):
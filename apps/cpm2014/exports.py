@@ -0,0 +1,175 @@
+import json
+from itertools import groupby
+
+from django.db.models import Count, Max
+from django.utils import translation
+from django.utils.encoding import force_unicode
+
+from apps.cpm_common.imports import ModelImport
+from apps.cpm_common.jobs import ConfirmationsExport, Export, ModelExport
+from apps.cpm2014.constants import TRANSLATION_LANGUAGES
+from apps.cpm2014.models import (
+    Submission, SubmissionScreening, SubmissionTranslation
+)
+
+
+TRANSLATION_JSON_FIELDS = (
+    'title', 'genre', 'synopsis', 'synopsis_short', 'director'
+)
+
+SCREENING_COLUMNS = (
+    'program__code', 'num', 'submission_id', 'submission__title',
+    'submission__director', 'submission__country', 'submission__length',
+)
+
+
+class SubmissionExport(ModelExport):
+    model = Submission
+    filename = 'submissions.xlsx'
+
+
+class SubmissionConfirmationsExport(ConfirmationsExport):
+    model = Submission
+    prefix = 'cpm2014'
+
+    def iter_confirmations(self, submissions):
+        from apps.cpm2014.pdf import iter_submission_confirmations
+        return iter_submission_confirmations(submissions)
+
+
+def get_translations_state():
+    """
+    Returns count and the last change time of submission translations,
+    a translation changes with its submission too
+    """
+    return SubmissionTranslation.objects.aggregate(
+        count=Count('id'),
+        updated_at=Max('updated_at'),
+        submission_updated_at=Max('submission__updated_at'),
+    )
+
+
+def get_translation_rows(translations):
+    """
+    Returns rows ``iter_translations_json`` takes of ``translations``
+    """
+    return translations.order_by('submission', 'language').values_list(
+        'submission_id', 'language', 'submission__language',
+        *TRANSLATION_JSON_FIELDS
+    ).iterator()
+
+
+def get_language_names():
+    """
+    Returns names of film languages in every translation language
+
+    Names are looked up under each language once.
+    """
+    choices = Submission._meta.get_field('language').flatchoices
+    language_names = {}
+    current_language = translation.get_language()
+    try:
+        for language, _name in TRANSLATION_LANGUAGES:
+            translation.activate(language)
+            language_names[language] = dict(
+                (value, force_unicode(label)) for value, label in choices
+            )
+    finally:
+        translation.activate(current_language)
+    return language_names
+
+
+def iter_translations_json(rows, language_names):
+    """
+    Yields a ``{submission_id: {language: translation}}`` JSON object
+    piece by piece, ``rows`` must go by submission
+    """
+    encoder = json.JSONEncoder(separators=(',', ':'))
+    yield '{'
+    for index, (submission_id, group) in enumerate(
+        groupby(rows, key=lambda row: row[0])
+    ):
+        data = {}
+        for row in group:
+            language, submission_language = row[1], row[2]
+            data[language] = dict(zip(TRANSLATION_JSON_FIELDS, row[3:]))
+            data[language]['language'] = language_names.get(
+                language, {}
+            ).get(submission_language, submission_language)
+        yield '%s%s:%s' % (
+            ',' if index else '',
+            encoder.encode(unicode(submission_id)),
+            encoder.encode(data),
+        )
+    yield '}'
+
+
+class TranslationsExport(Export):
+    """
+    Translations of all submissions, the full translations_all_json dump
+    """
+    filename = 'translations.json'
+    content_type = 'application/json'
+
+    def get_version(self):
+        return '%(count)s:%(updated_at)s:%(submission_updated_at)s' % (
+            get_translations_state()
+        )
+
+    def get_total(self):
+        return SubmissionTranslation.objects.count()
+
+    def iter_rows(self):
+        return get_translation_rows(SubmissionTranslation.objects.all())
+
+    def iter_content(self, rows):
+        return iter_translations_json(rows, get_language_names())
+
+
+class ScreeningExport(Export):
+    """
+    Films of every program in screening order
+    """
+    filename = 'screenings.xlsx'
+
+    def get_version(self):
+        # editing a program recreates its screenings with new ids
+        stats = SubmissionScreening.objects.aggregate(
+            count=Count('id'), last_id=Max('id'),
+            updated_at=Max('submission__updated_at'),
+        )
+        return '%(count)s:%(last_id)s:%(updated_at)s' % stats
+
+    def get_total(self):
+        return SubmissionScreening.objects.count()
+
+    def iter_rows(self):
+        yield ['program', 'num', 'submission', 'title', 'director',
+               'country', 'length']
+
+        countries = dict(
+            Submission._meta.get_field('country').flatchoices
+        )
+        current_lang = translation.get_language()
+        try:
+            translation.activate('en')
+            for row in SubmissionScreening.objects.order_by(
+                'program__code', 'num'
+            ).values_list(*SCREENING_COLUMNS).iterator():
+                row = list(row)
+                row[5] = force_unicode(countries.get(row[5], row[5]))
+                yield row
+        finally:
+            translation.activate(current_lang)
+
+
+class SubmissionImport(ModelImport):
+    model = Submission
+
+    def apply(self, changed):
+        super(SubmissionImport, self).apply(changed)
+
+        from apps.cpm2014.pdf import invalidate_submission_confirmation
+        for obj, changes in changed:
+            invalidate_submission_confirmation(obj)
+        Submission.bump_cache_version([obj.pk for obj, changes in changed])
@@ -4,6 +4,7 @@ from django.forms.util import ErrorList
 
 from form_utils.forms import BetterModelForm
 
+from apps.cpm_common.export import FORMAT_CHOICES
 from apps.cpm2014.constants import get_countries
 from apps.cpm2014.models import (
     ProgramTranslation, Program, Submission, SubmissionTranslation
@@ -84,25 +85,40 @@ class SubmissionForm(BetterModelForm):
         ]
 
 
+# only editable fields can be imported back
+EXPORT_FIELDS = [f.name for f in Submission._meta.fields if f.editable]
+
+
 class FieldsForm(forms.Form):
     fields = forms.MultipleChoiceField(
-        choices=[(f.name, f.name) for f in Submission._meta.fields],
+        choices=[(name, name) for name in EXPORT_FIELDS],
         widget=forms.CheckboxSelectMultiple
     )
+    format = forms.ChoiceField(choices=FORMAT_CHOICES, initial='xlsx')
+    compress = forms.BooleanField(
+        label=_('Gzip'), required=False,
+        help_text=_('CSV and JSON lines only, XLSX is compressed anyway')
+    )
 
     def __init__(self, data=None, files=None, auto_id='id_%s', prefix=None,
                  initial=None, error_class=ErrorList, label_suffix=':',
                  empty_permitted=False):
         if initial is None:
-            initial = {
-                'fields': [f.name for f in Submission._meta.fields]
-            }
+            initial = {'fields': EXPORT_FIELDS}
         super(FieldsForm, self).__init__(
             data, files, auto_id, prefix, initial, error_class,
             label_suffix, empty_permitted
         )
 
 
+class ImportForm(forms.Form):
+    file = forms.FileField(required=True)
+    dry_run = forms.BooleanField(
+        label=_('Dry run'), required=False, initial=True,
+        help_text=_('Only show the changes, nothing is saved')
+    )
+
+
 class SubmissionTranslationForm(forms.ModelForm):
     class Meta:
         model = SubmissionTranslation
@@ -128,6 +128,10 @@ class Submission(models.Model):
         null=True, blank=True, verbose_name=_('Papers received at'))
     vob_received_at = models.DateTimeField(
         null=True, blank=True, verbose_name=_('Vob received at'))
+    updated_at = models.DateTimeField(
+        auto_now=True, db_index=True, verbose_name=_('Updated at'))
+    # part of cache keys of rendered screening rows
+    cache_version = models.IntegerField(default=0, editable=False)
 
     preview = models.FloatField(
         null=True, blank=True, verbose_name=_('Preview result'))
@@ -142,6 +146,24 @@ class Submission(models.Model):
     def __repr__(self):
         return '<Film %s>' % (self.title)
 
+    def save(self, *args, **kwargs):
+        res = super(Submission, self).save(*args, **kwargs)
+        Submission.bump_cache_version([self.pk])
+        self.cache_version += 1
+
+        from apps.cpm2014.pdf import invalidate_submission_confirmation
+        invalidate_submission_confirmation(self)
+
+        return res
+
+    @classmethod
+    def bump_cache_version(cls, pks):
+        """
+        Outdates cached screening rows of the submissions
+        """
+        cls.objects.filter(pk__in=pks).update(
+            cache_version=models.F('cache_version') + 1
+        )
 
     def get_absolute_url(self):
         submission_hash = md5('%s%s' % (settings.SECRET_KEY, self.id))
@@ -196,10 +218,21 @@ class SubmissionTranslation(models.Model):
     synopsis_short = models.TextField(verbose_name=_('Synopsis (short)'), default='')
     director = models.CharField(verbose_name=_('Director'),
                                 max_length=1000, default='')
+    updated_at = models.DateTimeField(
+        auto_now=True, db_index=True, verbose_name=_('Updated at'))
 
     class Meta:
         unique_together = [('submission', 'language')]
 
+    def save(self, *args, **kwargs):
+        res = super(SubmissionTranslation, self).save(*args, **kwargs)
+        Submission.bump_cache_version([self.submission_id])
+        return res
+
+    def delete(self, *args, **kwargs):
+        Submission.bump_cache_version([self.submission_id])
+        return super(SubmissionTranslation, self).delete(*args, **kwargs)
+
 
 class Program(models.Model):
     code = models.SlugField(
@@ -278,3 +311,15 @@ class Event(TranslatableModel):
     )
 
     __unicode__ = lambda self: self.code
+
+
+def _invalidate_timetable(sender, **kwargs):
+    from apps.cpm2014.timetable import invalidate_timetable
+    invalidate_timetable()
+
+# the homepage timetable is cached, see apps.cpm2014.timetable
+for model in (City, Place, Event):
+    for sender in (model, model._meta.translations_model):
+        models.signals.post_save.connect(_invalidate_timetable, sender=sender)
+        models.signals.post_delete.connect(_invalidate_timetable,
+                                           sender=sender)
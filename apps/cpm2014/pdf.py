@@ -1,15 +1,19 @@
-import io
+import logging
 import re
 import os.path
-from cStringIO import StringIO
+from hashlib import sha1
+from multiprocessing import Pool
 
 from django.utils.translation import ugettext_lazy as _
 from django.utils import translation
 from django.conf import settings
+from django.db import connection
 
+from apps.cpm_common.pdf import ReportRenderer, pdf_cache
 from apps.cpm2014.constants import APP_ROOT
 from apps.cpm2014.models import Submission
 
+logger = logging.getLogger('cpm2014.pdf')
 
 SUBMIT_CONFIRMATION = [
     (_('Film'), [
@@ -29,101 +33,125 @@ SUBMIT_CONFIRMATION = [
 SUBMIT_CONFIRMATION_PERMISSIONS = [
     'allow_tv', 'allow_noncommercial', 'allow_network'
 ]
+SUBMIT_CONFIRMATION_FIELDS = [
+    field for section, fields in SUBMIT_CONFIRMATION for field in fields
+] + SUBMIT_CONFIRMATION_PERMISSIONS
 
 SUBMISSION_RST = {
     'en': 'submission_en.rst',
     'be': 'submission_be.rst',
     'ru': 'submission_ru.rst',
 }
-DEFAULT_SUBMISSION_RST = SUBMISSION_RST['en']
-
-def _escape_rst(value):
-    lines = []
-    for line in unicode(value).split('\n'):
-        lines.append(
-            ''.join(
-                '\%s' % c if c != ' ' else c for\
-                c in line.strip()
-            )
-        )
-    return '\n\n'.join(lines)
-
-def _get_rst_fields(sections, permissions):
-    sections_rst = []
-    for section, cv_items in sections:
-        if not any(value for name, value in cv_items):
-            continue
-
-        section_rst = '\n'.join(
-            u'* %s\n    %s' % (
-                n,
-                '\n    '.join(_escape_rst(v).split('\n'))
-            ) \
-            for n,v in cv_items if not (v is None or v == '')
-        )
-
-        sections_rst.append(u'\n%s\n%s\n\n%s' % (
-            section, '-' * len(section), section_rst
-        ))
-
-    for section, cv_items in permissions:
-        section_rst = '\n\n'.join(
-            '* ' + _escape_rst(name) for name in cv_items
-        )
-        sections_rst.append(u'\n%s\n%s\n\n%s' % (
-            section, '-' * len(section), section_rst
-        ))
-
-    return {
-        'sections': '\n'.join(sections_rst),
-    }
+renderer = ReportRenderer(
+    docs=os.path.join(APP_ROOT, 'docs'),
+    headers=SUBMISSION_RST,
+    default_lang='en',
+    stylesheet='submission2.stylesheet',
+    model=Submission,
+    sections=SUBMIT_CONFIRMATION,
+    permissions=(_('Permissions'), SUBMIT_CONFIRMATION_PERMISSIONS),
+)
 
 
 def get_submission_confirmation_report(submission):
-    sections = []
-    for section, fields in SUBMIT_CONFIRMATION:
-        cv_items = []
-        for field in fields:
-            model_field = Submission._meta.get_field_by_name(field)[0]
-            name = model_field.verbose_name
-            if getattr(model_field, 'choices', None):
-                value = getattr(submission, 'get_%s_display' % field)()
-            else:
-                value = getattr(submission, field)
-            cv_items.append((name, value))
+    lang = translation.get_language().lower()
+    return renderer.render(renderer.get_rst(submission, lang))
 
-        sections.append((section, cv_items))
 
-    permissions = []
-    for field in SUBMIT_CONFIRMATION_PERMISSIONS:
-        value = getattr(submission, field)
-        if value != 1:
-            continue
+def _get_confirmation_hash(submission):
+    digest = sha1()
+    for field in SUBMIT_CONFIRMATION_FIELDS:
+        digest.update(unicode(getattr(submission, field)).encode('utf-8'))
+        digest.update('\0')
+    return digest.hexdigest()
 
-        model_field = Submission._meta.get_field_by_name(field)[0]
-        name = model_field.verbose_name
-        permissions.append(name)
-    if permissions:
-        permissions = [(_('Permissions'), permissions)]
 
+def invalidate_submission_confirmation(submission):
+    """
+    Drops cached reports which were rendered from outdated submission data
+    """
+    pdf_cache.invalidate('cpm2014-%s' % submission.pk,
+                         keep=_get_confirmation_hash(submission))
 
-    docs = os.path.join(APP_ROOT, 'docs')
-    lang = translation.get_language().lower()
-    submission_rst = os.path.join(
-        docs, SUBMISSION_RST.get(lang, DEFAULT_SUBMISSION_RST))
-    with io.open(submission_rst, encoding='utf-8') as submission_head:
-        rst_data = submission_head.read() % _get_rst_fields(
-            sections, permissions)
-
-    from rst2pdf.createpdf import RstToPdf
-    pdf_creator = RstToPdf(
-        stylesheets=[os.path.join(docs, 'submission2.stylesheet')],
-        font_path=['/usr/share/fonts/TTF/'],
-        breaklevel=0,
+
+def _get_cache_key(submission):
+    return 'cpm2014-%s-%s-%s' % (
+        submission.pk,
+        _get_confirmation_hash(submission),
+        translation.get_language().lower(),
     )
 
-    with io.open('/tmp/cpm.rst', 'w', encoding='utf-8') as w:
-        w.write(rst_data)
-    pdf_content = StringIO()
-    pdf_creator.createPdf(text=rst_data, output=pdf_content)
-    return pdf_content.getvalue()
+
+def open_submission_confirmation(submission):
+    """
+    Returns cached confirmation report as an open file, or None
+    """
+    return pdf_cache.open(_get_cache_key(submission))
+
+
+def get_submission_confirmation_pdf(submission):
+    """
+    Returns confirmation report from the PDF cache, rendering it on a miss
+    """
+    key = _get_cache_key(submission)
+
+    pdf = pdf_cache.get(key)
+    if pdf is None:
+        pdf = get_submission_confirmation_report(submission)
+        pdf_cache.set(key, pdf)
+    return pdf
+
+
+def _render_confirmation(args):
+    submission, lang = args
+    translation.activate(lang)
+    try:
+        return submission, get_submission_confirmation_pdf(submission)
+    except Exception:
+        logger.exception('Failed to render submission %s' % submission.pk)
+        return submission, None
+    finally:
+        translation.deactivate()
+
+
+def iter_submission_confirmations(submissions, processes=None):
+    """
+    Yields ``(submission, pdf)`` pairs, ``pdf`` is None if rendering failed.
+
+    Cached reports come first, the rest are rendered in parallel by a pool
+    of ``processes`` (CPU count by default) and yielded as they are ready.
+    """
+    current_lang = translation.get_language()
+    missing = []
+    try:
+        for submission in submissions:
+            translation.activate(submission.submission_language)
+            pdf = pdf_cache.get(_get_cache_key(submission))
+            if pdf is None:
+                missing.append((submission, submission.submission_language))
+            else:
+                yield submission, pdf
+    finally:
+        translation.activate(current_lang)
+
+    if not missing:
+        return
+
+    logger.info('Rendering %d confirmations' % len(missing))
+
+    # forked workers must not share the database socket with us
+    connection.close()
+    pool = Pool(processes, initializer=renderer.warm)
+    try:
+        results = pool.imap_unordered(_render_confirmation, missing)
+        for done, (submission, pdf) in enumerate(results, 1):
+            logger.info('Rendered %d of %d confirmations' % (
+                done, len(missing)
+            ))
+            yield submission, pdf
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
@@ -2,19 +2,26 @@ import logging
 
 from django.conf import settings
 from django.core.mail import EmailMessage
-from django.utils import translation
+from django.utils import timezone, translation
 from django.template import loader
 
 from apps.cpm2014.models import Submission
+from apps.cpm_common.mail import queue_email
+from apps.cpm2014.pdf import get_submission_confirmation_pdf, renderer
 from celery import Task
+from celery.signals import worker_process_init
 
 logger = logging.getLogger('cpm2014.tasks')
 
 
+@worker_process_init.connect
+def warm_pdf_renderer(**kwargs):
+    renderer.warm()
+
+
 class SendSubmissionEmail(Task):
     def create_pdf(self, submission):
-        from apps.cpm2014.pdf import get_submission_confirmation_report
-        return get_submission_confirmation_report(submission)
+        return get_submission_confirmation_pdf(submission)
 
     def get_email_message(self, submission):
         lang = translation.get_language().lower()
@@ -25,11 +32,25 @@ class SendSubmissionEmail(Task):
             }
         )
         
-    def run(self, submission):
-        logger.info('SendSubmissionEmail for submission %s' % (
-            submission.id
-        ))
+    def run(self, submission_id):
+        logger.info('SendSubmissionEmail for submission %s' % submission_id)
+
+        # the flag is the dedup key, a retried or repeated call finds it set
+        claimed = Submission.objects.filter(
+            pk=submission_id, comment_email_sent=False
+        ).update(
+            comment_email_sent=True,
+            email_sent_at=timezone.now(),
+            updated_at=timezone.now(),
+        )
+        if not claimed:
+            logger.info('SendSubmissionEmail: %s is already sent' % (
+                submission_id
+            ))
+            return
+
         try:
+            submission = Submission.objects.get(pk=submission_id)
             translation.activate(submission.submission_language)
 
             email = EmailMessage(
@@ -44,16 +65,26 @@ class SendSubmissionEmail(Task):
                 'cpm2014.pdf', self.create_pdf(submission), 'application/pdf'
             )
 
-            email.send()
+            queue_email(email)
         except:
             logger.exception('')
+            Submission.objects.filter(pk=submission_id).update(
+                comment_email_sent=False,
+                email_sent_at=None,
+                updated_at=timezone.now(),
+            )
             raise
         finally:
             translation.deactivate()
-            try:
-                submission = Submission.objects.get(pk=submission.pk)
-            except Submission.DoesNotExist:
-                logger.exception('Failed to update "email sent" status')
-            else:
-                submission.comment_email_sent = True
-                submission.save()
+
+
+class RenderSubmissionPdf(Task):
+    def run(self, submission_id):
+        logger.info('RenderSubmissionPdf for submission %s' % submission_id)
+
+        submission = Submission.objects.get(pk=submission_id)
+        try:
+            translation.activate(submission.submission_language)
+            get_submission_confirmation_pdf(submission)
+        finally:
+            translation.deactivate()
@@ -1,10 +1,8 @@
 # -*- coding: utf-8 -*-
-from collections import defaultdict
-from datetime import datetime, date, time
-
 from django import template
 
-from apps.cpm2014.models import Event, NewsEntry
+from apps.cpm2014.models import NewsEntry
+from apps.cpm2014.timetable import get_timetable
 
 
 register = template.Library()
@@ -18,24 +16,4 @@ def cpm2014_news():
 
 @register.inclusion_tag('cpm2014/tags/timetable.html')
 def cpm2014_timetable():
-    today_12pm = datetime.combine(date.today(), time())
-    # this query requires a lot of subqueries later...
-    # but I have no time to find a workaround for hvad
-    future_events = Event.objects.language().filter(starts_at__gte=today_12pm)
-    future_events = future_events.order_by('starts_at')
-
-    cities = defaultdict(lambda: defaultdict(list))
-    for event in future_events:
-        cities[event.place.city][event.starts_at.date()].append(event)
-
-    timetable = sorted(
-        (
-            (
-                city,
-                sorted(days.iteritems(), key=lambda x: x[0])
-            ) for city, days in cities.iteritems()
-        ),
-        key=lambda x: -x[0].priority
-    )
-
-    return {'timetable': timetable}
+    return {'timetable': get_timetable()}
@@ -4,9 +4,14 @@ when you run "manage.py test".
 
 Replace this with more appropriate tests for your application.
 """
+import json
 
+from django.contrib.auth.models import User
+from django.db import connection
 from django.test import TestCase
 
+from apps.cpm2014.models import Submission, SubmissionTranslation
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,3 +19,72 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class SubmissionChangeListTest(TestCase):
+    url = '/admin/cpm2014/submission/'
+
+    def setUp(self):
+        text = u'x' * 4000
+        Submission.objects.bulk_create([
+            Submission(
+                title=u'film%d' % i, title_en=u'film%d' % i, country='BY',
+                language='en', section=1, length=5, aspect_ratio='4:3',
+                year=2014, premiere=1, budget='1', backlink=1,
+                director='D', director_email='d@example.com', applicant='A',
+                applicant_email='a@example.com', submission_language='en',
+                synopsis=text, film_awards=text, director_awards=text,
+                director_address=text, producer_address=text,
+                applicant_address=text, other_credits=text,
+                film_link='http://example.com/%d' % i,
+                extra_data=json.dumps({'index': i}),
+            ) for i in range(100)
+        ])
+        SubmissionTranslation.objects.bulk_create([
+            SubmissionTranslation(submission=submission, language='en')
+            for submission in Submission.objects.all()[:50]
+        ])
+
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+
+    def _get(self, per_page):
+        from django.contrib import admin
+        import apps.cpm2014.admin  # registers the model admins
+
+        model_admin = admin.site._registry[Submission]
+        old_per_page = model_admin.list_per_page
+        model_admin.list_per_page = per_page
+
+        connection.use_debug_cursor = True
+        connection.queries = []
+        try:
+            response = self.client.get(self.url)
+            queries = [query['sql'] for query in connection.queries]
+        finally:
+            connection.use_debug_cursor = None
+            model_admin.list_per_page = old_per_page
+
+        self.assertEqual(response.status_code, 200)
+        return response, queries
+
+    def test_queries_do_not_grow_with_rows(self):
+        response, few_queries = self._get(10)
+        response, queries = self._get(100)
+
+        self.assertEqual(len(queries), len(few_queries))
+        self.assertContains(response, 'film99')
+        # every row is rendered, its translation languages included
+        self.assertContains(response, '<tr class=', count=100)
+
+    def test_long_texts_are_not_loaded(self):
+        response, queries = self._get(100)
+
+        page_query = [
+            sql for sql in queries
+            if sql.startswith('SELECT "cpm2014_submission"."id"')
+        ]
+        self.assertEqual(len(page_query), 1)
+        columns = page_query[0].split(' FROM ')[0]
+        self.assertNotIn('"synopsis"', columns)
+        self.assertNotIn('"director_address"', columns)
@@ -0,0 +1,134 @@
+from collections import defaultdict, namedtuple
+from datetime import datetime, date, time, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.utils import timezone, translation
+
+from apps.cpm_common.models import CacheVersion
+from apps.cpm2014.models import City, Event, Place
+
+
+# used while there are no events to drop off the timetable
+TIMETABLE_CACHE_TIMEOUT = getattr(
+    settings, 'TIMETABLE_CACHE_TIMEOUT', 24 * 60 * 60  # seconds
+)
+
+TimetableCity = namedtuple('TimetableCity', 'id code name priority')
+TimetablePlace = namedtuple('TimetablePlace', 'id name address')
+TimetableEvent = namedtuple(
+    'TimetableEvent', 'id starts_at program_id name description place'
+)
+
+
+def _get_cache_key(language_code):
+    # the version is kept in the database, so a change made in one
+    # process outdates timetables cached by every other one
+    return 'cpm2014-timetable-%s-%s' % (
+        language_code, CacheVersion.get('cpm2014-timetable')
+    )
+
+
+def invalidate_timetable():
+    """
+    Outdates cached timetables of all languages
+    """
+    CacheVersion.bump('cpm2014-timetable')
+
+
+def _iter_events(language_code, since):
+    """
+    Yields ``(city, event)`` pairs of events starting at ``since`` or
+    later, read with their places, cities and translations in one query
+
+    Events without a translation into ``language_code`` are left out.
+    """
+    qn = connection.ops.quote_name
+    tables = {
+        'event': qn(Event._meta.db_table),
+        'event_t': qn(Event._meta.translations_model._meta.db_table),
+        'place': qn(Place._meta.db_table),
+        'place_t': qn(Place._meta.translations_model._meta.db_table),
+        'city': qn(City._meta.db_table),
+        'city_t': qn(City._meta.translations_model._meta.db_table),
+    }
+
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT e.id, e.starts_at, e.program_id, et.name, et.description, '
+        'p.id, pt.name, pt.address, c.id, c.code, ct.name, c.priority '
+        'FROM %(event)s e '
+        'INNER JOIN %(event_t)s et '
+        'ON et.master_id = e.id AND et.language_code = %%s '
+        'INNER JOIN %(place)s p ON p.id = e.place_id '
+        'LEFT OUTER JOIN %(place_t)s pt '
+        'ON pt.master_id = p.id AND pt.language_code = %%s '
+        'INNER JOIN %(city)s c ON c.id = p.city_id '
+        'LEFT OUTER JOIN %(city_t)s ct '
+        'ON ct.master_id = c.id AND ct.language_code = %%s '
+        'WHERE e.starts_at >= %%s '
+        'ORDER BY e.starts_at, e.id' % tables,
+        [language_code, language_code, language_code,
+         connection.ops.value_to_db_datetime(since)]
+    )
+
+    for row in cursor.fetchall():
+        place = TimetablePlace(row[5], row[6] or '', row[7] or '')
+        city = TimetableCity(row[8], row[9], row[10] or '', row[11])
+        yield city, TimetableEvent(*(row[:5] + (place,)))
+
+
+def build_timetable(language_code, since):
+    """
+    Returns ``(city, [(day, [event, ...]), ...])`` items of events
+    starting at ``since`` or later, cities go by priority
+    """
+    cities = defaultdict(lambda: defaultdict(list))
+    for city, event in _iter_events(language_code, since):
+        cities[city][event.starts_at.date()].append(event)
+
+    return sorted(
+        (
+            (
+                city,
+                sorted(days.iteritems(), key=lambda x: x[0])
+            ) for city, days in cities.iteritems()
+        ),
+        key=lambda x: -x[0].priority
+    )
+
+
+def get_timetable():
+    """
+    Returns the timetable of today and later events in the current
+    language, cached until an event, place or city is saved
+
+    Events of a day are shown till the day ends, so the cached timetable
+    expires at the end of the day of its first event.
+    """
+    language_code = translation.get_language()
+    key = _get_cache_key(language_code)
+    timetable = cache.get(key)
+    if timetable is not None:
+        return timetable
+
+    tz = timezone.get_default_timezone()
+    today = timezone.make_aware(datetime.combine(date.today(), time()), tz)
+    timetable = build_timetable(language_code, today)
+
+    starts = [
+        event.starts_at
+        for city, days in timetable for day, events in days
+        for event in events
+    ]
+    timeout = TIMETABLE_CACHE_TIMEOUT
+    if starts:
+        first_day = timezone.localtime(min(starts), tz).date()
+        expires_at = timezone.make_aware(
+            datetime.combine(first_day + timedelta(days=1), time()), tz
+        )
+        timeout = max(1, int((expires_at - timezone.now()).total_seconds()))
+
+    cache.set(key, timetable, timeout)
+    return timetable
@@ -1,26 +1,37 @@
 
 # -*- coding: utf-8 -*-
+import calendar
+import hashlib
 import io
-import json
 import os.path
-from collections import defaultdict
+from datetime import datetime
 
 from django.contrib.admin.views.decorators import staff_member_required
 from django.db import transaction
-from django.http import HttpResponse, HttpResponseRedirect
+from django.db.models import Q
+from django.http import (
+    HttpResponse, HttpResponseBadRequest, HttpResponseRedirect
+)
 from django.shortcuts import (
     get_object_or_404, render_to_response, redirect, redirect
 )
 from django.template import RequestContext
-from django.utils import translation
+from django.utils import timezone, translation
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date, parse_http_date_safe
 from django.utils.translation import ugettext_lazy as _
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
 from django.views.generic.base import RedirectView
 from django.conf import settings
 
 from rest_framework import viewsets
 
 from apps.cpm2014.constants import APP_ROOT, TRANSLATION_LANGUAGES
+from apps.cpm2014.exports import (
+    get_language_names, get_translation_rows, get_translations_state,
+    iter_translations_json
+)
 from apps.cpm2014.models import (
     Event, NewsEntry, Program, ProgramTranslation,
     Submission, SubmissionScreening, SubmissionTranslation
@@ -31,6 +42,17 @@ from apps.cpm2014.forms import (
 )
 from apps.cpm2014.serializers import SubmissionSerializer
 from apps.cpm2014.tasks import SendSubmissionEmail
+from apps.cpm_common.jobs import start_export
+from apps.cpm_common.outbox import enqueue_task
+from apps.cpm_common.translations import (
+    get_translation_resolver, prefetch_translations
+)
+
+
+# rendered screening rows are dropped sooner when their film is saved
+SCREENING_CACHE_TIMEOUT = getattr(
+    settings, 'SCREENING_CACHE_TIMEOUT', 7 * 24 * 60 * 60  # seconds
+)
 
 
 class IndexView(RedirectView):
@@ -43,9 +65,9 @@ def submit(request):
     if request.method == 'POST' and form.is_valid():
         submission = form.save(commit=False)
         submission.submission_language = translation.get_language()
-        submission.save()
-
-        SendSubmissionEmail().apply_async(args=[submission])
+        with transaction.commit_on_success():
+            submission.save()
+            enqueue_task(SendSubmissionEmail, args=[submission.id])
 
         return render_to_response(
             'cpm2014/submit_done.html',
@@ -276,59 +298,131 @@ def translation_edit(request, submission_id, lang):
                               context_instance=RequestContext(request))
 
 
+def _parse_since(value):
+    """
+    Returns an aware datetime of an ISO 8601 or HTTP date ``since``
+    parameter, None if it can't be parsed
+    """
+    try:
+        since = parse_datetime(value)
+    except ValueError:
+        return None
+
+    if since is None:
+        seconds = parse_http_date_safe(value)
+        if seconds is None:
+            return None
+        since = datetime.utcfromtimestamp(seconds).replace(tzinfo=timezone.utc)
+    elif timezone.is_naive(since):
+        since = timezone.make_aware(since, timezone.get_default_timezone())
+    return since
+
+
+def _get_translations_state(request):
+    if not hasattr(request, '_translations_state'):
+        request._translations_state = get_translations_state()
+    return request._translations_state
+
+
+def _translations_etag(request):
+    since = request.GET.get('since')
+    if since is not None and _parse_since(since) is None:
+        return None
+
+    state = _get_translations_state(request)
+    return hashlib.md5(repr((
+        state['count'], state['updated_at'], state['submission_updated_at'],
+        since,
+    ))).hexdigest()
+
+
 @staff_member_required
+@condition(etag_func=_translations_etag)
 def translations_all_json(request):
-    response_dict = defaultdict(dict)
-
-    for t in SubmissionTranslation.objects.all().select_related('submission'):
-        translation.activate(t.language)
+    """
+    Streams translations of all submissions as compact JSON
 
-        response_dict[t.submission_id][t.language] = {
-            'title': t.title,
-            'genre': t.genre,
-            'synopsis': t.synopsis,
-            'synopsis_short': t.synopsis_short,
-            'director': t.director,
-            'language': t.submission.get_language_display(),
-        }
+    With ``since`` only translations changed at that time or later are
+    sent, the Last-Modified header of a response is the ``since`` to
+    poll with next. Deleted translations only drop out of a full dump.
+    """
+    translations = SubmissionTranslation.objects.all()
+
+    since = request.GET.get('since')
+    if since is not None:
+        since = _parse_since(since)
+        if since is None:
+            return HttpResponseBadRequest('Invalid since')
+        translations = translations.filter(
+            Q(updated_at__gte=since) | Q(submission__updated_at__gte=since)
+        )
 
-    translation.deactivate()
+    # the name of the film language is given in the translation language
+    response = HttpResponse(
+        iter_translations_json(
+            get_translation_rows(translations), get_language_names()
+        ),
+        content_type='application/json'
+    )
 
-    return HttpResponse(
-        json.dumps(response_dict, indent=2),
-        content_type="application/json"
+    state = _get_translations_state(request)
+    updated_at = max(
+        state['updated_at'], state['submission_updated_at']
     )
+    if updated_at is not None:
+        response['Last-Modified'] = http_date(
+            calendar.timegm(updated_at.utctimetuple())
+        )
+    return response
+
+
+@staff_member_required
+def translations_export(request):
+    job = start_export('apps.cpm2014.exports.TranslationsExport', {})
+    return redirect('export_status', job.id)
 
 
 @staff_member_required
 def program_list(request):
     programs = Program.objects.all().order_by('id')
-    programs = programs.prefetch_related()
+    programs = get_translation_resolver(request).assign(
+        programs, ProgramTranslation, 'program'
+    )
 
     context = {'programs': programs}
     return render_to_response('cpm2014/program_list.html', context,
                               context_instance=RequestContext(request))
 
 
+@staff_member_required
+def program_export(request):
+    job = start_export('apps.cpm2014.exports.ScreeningExport', {})
+    return redirect('export_status', job.id)
+
+
+def _get_screenings(request, program):
+    screenings = sorted(
+        program.submissionscreening_set.select_related('submission'),
+        key=lambda screening: screening.num
+    )
+    get_translation_resolver(request).assign(
+        [screening.submission for screening in screenings],
+        SubmissionTranslation, 'submission'
+    )
+    return screenings
+
+
 def program_details(request, program_id):
     program = get_object_or_404(Program, id=program_id)
-    try:
-        trans = ProgramTranslation.objects.get(
-            language=translation.get_language(), program=program
-        )
-    except ProgramTranslation.DoesNotExist:
-        trans = None
-    screenings_qs = program.submissionscreening_set.all()
-    screenings_qs = screenings_qs.select_related()
-    screenings_qs = screenings_qs.prefetch_related('submission__submissiontranslation_set')
+    get_translation_resolver(request).assign(
+        [program], ProgramTranslation, 'program'
+    )
 
     context = {
         'program': program,
-        'translation': trans,
-        'screenings': sorted(
-            screenings_qs,
-            key=lambda screening: screening.num
-        ),
+        'translation': program.translation,
+        'screenings': _get_screenings(request, program),
+        'screening_cache_timeout': SCREENING_CACHE_TIMEOUT,
         'editable': request.user.is_staff
     }
     return render_to_response('cpm2014/program_details.html', context,
@@ -371,7 +465,12 @@ def program_edit(request, program_id=None):
         program = form.save(commit=False)
         program.save()
 
-        SubmissionScreening.objects.filter(program=program).delete()
+        screenings = SubmissionScreening.objects.filter(program=program)
+        Submission.bump_cache_version(
+            list(screenings.values_list('submission_id', flat=True)) +
+            [submission.pk for submission in form.cleaned_data['films']]
+        )
+        screenings.delete()
         SubmissionScreening.objects.bulk_create(
             [
                 SubmissionScreening(
@@ -402,23 +501,21 @@ def program_edit(request, program_id=None):
 
 
 def event_details(request, event_id):
-    event = get_object_or_404(Event, id=event_id)
+    event = get_object_or_404(
+        Event.objects.select_related('place', 'program'), id=event_id
+    )
+    resolver = get_translation_resolver(request)
+    prefetch_translations([event], 'place', resolver=resolver)
 
+    screenings = []
     if event.program:
-        screenings_qs = event.program.submissionscreening_set.all()
-        screenings_qs = screenings_qs.select_related()
-        screenings_qs = screenings_qs.prefetch_related(
-            'submission__submissiontranslation_set'
-        )
-    else:
-        screenings_qs = SubmissionScreening.objects.none()
+        resolver.assign([event.program], ProgramTranslation, 'program')
+        screenings = _get_screenings(request, event.program)
 
     context = {
         'event': event,
-        'screenings': sorted(
-            screenings_qs,
-            key=lambda screening: screening.num
-        ),
+        'screenings': screenings,
+        'screening_cache_timeout': SCREENING_CACHE_TIMEOUT,
     }
     return render_to_response('cpm2014/event_details.html', context,
                               context_instance=RequestContext(request))
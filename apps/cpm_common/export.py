@@ -0,0 +1,564 @@
+import csv
+import datetime
+import json
+import math
+import re
+import struct
+import time
+import zipfile
+import zlib
+from collections import OrderedDict
+from decimal import Decimal
+from xml.etree.cElementTree import iterparse
+from xml.sax.saxutils import escape
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+from openpyxl.cell import column_index_from_string, get_column_letter
+from openpyxl.shared.date_time import SharedDate
+from openpyxl.writer.theme import write_theme
+
+
+XLSX_CONTENT_TYPE = (
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+)
+
+FORMAT_CHOICES = (
+    ('xlsx', 'XLSX'),
+    ('csv', 'CSV'),
+    ('jsonl', 'JSON lines'),
+)
+
+
+class _StreamBuffer(object):
+    """
+    Write-only file object which hands out written data on ``pop()``.
+
+    zipfile only needs ``write`` and ``tell`` when entries are added
+    with ``writestr``, so an archive can be sent while it is being built.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = ''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_zip(entries):
+    """
+    Yields a ZIP archive of ``(name, content)`` pairs chunk by chunk.
+
+    Only one entry is held in memory at a time. Entries are stored
+    without compression, this is meant for already compressed files.
+    """
+    buf = _StreamBuffer()
+    archive = zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED)
+    for name, content in entries:
+        archive.writestr(name, content)
+        yield buf.pop()
+
+    archive.close()
+    yield buf.pop()
+
+
+def iter_values(queryset, field_names, chunk_size=500):
+    """
+    Yields lists of ``field_names`` values of ``queryset`` objects.
+
+    Only the requested columns are fetched, ``chunk_size`` rows per query
+    in primary key order. Choice fields are shown by their labels in the
+    active language, like ``get_FOO_display()`` does, through lookups
+    which are built once per call.
+    """
+    choice_columns = []
+    for index, name in enumerate(field_names):
+        field = queryset.model._meta.get_field_by_name(name)[0]
+        if field.choices:
+            choice_columns.append((index, dict(
+                (value, unicode(label)) for value, label in field.flatchoices
+            )))
+
+    # the primary key is fetched last to continue from it
+    queryset = queryset.order_by('pk').values_list(
+        *(list(field_names) + ['pk'])
+    )
+    last_pk = None
+    while True:
+        chunk = queryset
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            return
+
+        for values in chunk:
+            row = list(values[:-1])
+            for index, labels in choice_columns:
+                row[index] = labels.get(row[index], row[index])
+            yield row
+        last_pk = chunk[-1][-1]
+
+
+class ZipStream(object):
+    """
+    Deflated ZIP archive written strictly forward.
+
+    ``zipfile`` needs the whole content of an entry to write it. Here the
+    checksum and sizes of an entry follow its data in a descriptor record,
+    so the content may be an iterable of chunks of unknown total length.
+    """
+    def __init__(self):
+        self.offset = 0
+        self.entries = []
+
+    def _out(self, data):
+        self.offset += len(data)
+        return data
+
+    def iter_entry(self, name, chunks):
+        year, month, day, hours, minutes, seconds = time.localtime()[:6]
+        dostime = hours << 11 | minutes << 5 | seconds // 2
+        dosdate = (year - 1980) << 9 | month << 5 | day
+        header_offset = self.offset
+
+        yield self._out(struct.pack(
+            zipfile.structFileHeader, zipfile.stringFileHeader,
+            20, 0, 0x08, zipfile.ZIP_DEFLATED, dostime, dosdate,
+            0, 0, 0, len(name), 0
+        ) + name)
+
+        crc = 0
+        file_size = 0
+        compress_size = 0
+        compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15
+        )
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            data = compressor.compress(chunk)
+            if data:
+                compress_size += len(data)
+                yield self._out(data)
+        data = compressor.flush()
+        compress_size += len(data)
+        crc &= 0xffffffff
+
+        yield self._out(data + struct.pack(
+            '<4s3L', 'PK\x07\x08', crc, compress_size, file_size
+        ))
+        self.entries.append((
+            name, dostime, dosdate, crc, compress_size, file_size,
+            header_offset,
+        ))
+
+    def close(self):
+        directory_offset = self.offset
+        records = []
+        for (name, dostime, dosdate, crc, compress_size, file_size,
+             header_offset) in self.entries:
+            records.append(struct.pack(
+                zipfile.structCentralDir, zipfile.stringCentralDir,
+                20, 0, 20, 0, 0x08, zipfile.ZIP_DEFLATED, dostime, dosdate,
+                crc, compress_size, file_size, len(name), 0, 0, 0, 0, 0,
+                header_offset,
+            ) + name)
+        directory = ''.join(records)
+
+        return self._out(directory + struct.pack(
+            zipfile.structEndArchive, zipfile.stringEndArchive,
+            0, 0, len(records), len(records), len(directory),
+            directory_offset, 0
+        ))
+
+
+XLSX_PARTS = (
+    ('[Content_Types].xml',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+     '<Types xmlns="http://schemas.openxmlformats.org/package/2006/'
+     'content-types">'
+     '<Default Extension="rels" ContentType="application/'
+     'vnd.openxmlformats-package.relationships+xml"/>'
+     '<Default Extension="xml" ContentType="application/xml"/>'
+     '<Override PartName="/xl/workbook.xml" ContentType="application/'
+     'vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+     '<Override PartName="/xl/worksheets/sheet1.xml" ContentType='
+     '"application/vnd.openxmlformats-officedocument.spreadsheetml.'
+     'worksheet+xml"/>'
+     '<Override PartName="/xl/styles.xml" ContentType="application/'
+     'vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+     '<Override PartName="/xl/sharedStrings.xml" ContentType="application/'
+     'vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"/>'
+     '<Override PartName="/xl/theme/theme1.xml" ContentType="application/'
+     'vnd.openxmlformats-officedocument.theme+xml"/>'
+     '</Types>'),
+    ('_rels/.rels',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+     '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/'
+     'relationships">'
+     '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/'
+     'officeDocument/2006/relationships/officeDocument" '
+     'Target="xl/workbook.xml"/>'
+     '</Relationships>'),
+    ('xl/workbook.xml',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+     '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/'
+     'main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/'
+     'relationships">'
+     '<workbookPr/>'
+     '<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets>'
+     '</workbook>'),
+    ('xl/_rels/workbook.xml.rels',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+     '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/'
+     'relationships">'
+     '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/'
+     'officeDocument/2006/relationships/worksheet" '
+     'Target="worksheets/sheet1.xml"/>'
+     '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/'
+     'officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+     '<Relationship Id="rId3" Type="http://schemas.openxmlformats.org/'
+     'officeDocument/2006/relationships/sharedStrings" '
+     'Target="sharedStrings.xml"/>'
+     '<Relationship Id="rId4" Type="http://schemas.openxmlformats.org/'
+     'officeDocument/2006/relationships/theme" Target="theme/theme1.xml"/>'
+     '</Relationships>'),
+    # openpyxl refuses to read a workbook without a theme
+    ('xl/theme/theme1.xml', write_theme()),
+    # style 1 is used for dates
+    ('xl/styles.xml',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+     '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/'
+     '2006/main">'
+     '<numFmts count="1"><numFmt numFmtId="164" '
+     'formatCode="yyyy-mm-dd h:mm:ss"/></numFmts>'
+     '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font>'
+     '</fonts>'
+     '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+     '<fill><patternFill patternType="gray125"/></fill></fills>'
+     '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/>'
+     '</border></borders>'
+     '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" '
+     'borderId="0"/></cellStyleXfs>'
+     '<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" '
+     'borderId="0" xfId="0"/><xf numFmtId="164" fontId="0" fillId="0" '
+     'borderId="0" xfId="0" applyNumberFormat="1"/></cellXfs>'
+     '</styleSheet>'),
+)
+
+SHEET_HEAD = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/'
+    'main"><sheetData>'
+)
+SHEET_TAIL = '</sheetData></worksheet>'
+
+# characters XML 1.0 does not allow even escaped
+_xml_illegal_re = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+
+def _is_finite(value):
+    if isinstance(value, float):
+        return not (math.isnan(value) or math.isinf(value))
+    if isinstance(value, Decimal):
+        return value.is_finite()
+    return True
+
+
+def _iter_sheet(rows, strings):
+    shared_date = SharedDate()
+    columns = {}
+
+    yield SHEET_HEAD
+    for row_index, row in enumerate(rows, 1):
+        cells = []
+        for col_index, value in enumerate(row):
+            if value is None:
+                continue
+
+            if col_index not in columns:
+                columns[col_index] = get_column_letter(col_index + 1)
+            ref = '%s%d' % (columns[col_index], row_index)
+
+            if isinstance(value, bool):
+                cells.append('<c r="%s" t="b"><v>%d</v></c>' % (ref, value))
+            elif not _is_finite(value):
+                # XLSX numbers can't be nan or infinite, keep them as text
+                index = strings.setdefault(unicode(value), len(strings))
+                cells.append('<c r="%s" t="s"><v>%d</v></c>' % (ref, index))
+            elif isinstance(value, float):
+                cells.append('<c r="%s"><v>%r</v></c>' % (ref, value))
+            elif isinstance(value, (int, long, Decimal)):
+                cells.append('<c r="%s"><v>%s</v></c>' % (ref, value))
+            elif isinstance(value, (datetime.datetime, datetime.date)):
+                cells.append('<c r="%s" s="1"><v>%r</v></c>' % (
+                    ref, shared_date.datetime_to_julian(value)
+                ))
+            else:
+                index = strings.setdefault(unicode(value), len(strings))
+                cells.append('<c r="%s" t="s"><v>%d</v></c>' % (ref, index))
+
+        yield '<row r="%d">%s</row>' % (row_index, ''.join(cells))
+    yield SHEET_TAIL
+
+
+def _iter_shared_strings(strings):
+    yield (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/'
+        'main" uniqueCount="%d">' % len(strings)
+    )
+    for value, index in sorted(strings.iteritems(), key=lambda i: i[1]):
+        value = escape(_xml_illegal_re.sub(u'', value))
+        yield (
+            u'<si><t xml:space="preserve">%s</t></si>' % value
+        ).encode('utf-8')
+    yield '</sst>'
+
+
+def iter_xlsx(rows):
+    """
+    Yields a one sheet XLSX workbook of ``rows`` chunk by chunk.
+
+    Rows are compressed and sent as they come. Only the shared string
+    table is kept until the end, it is written after the sheet.
+    """
+    archive = ZipStream()
+    for name, content in XLSX_PARTS:
+        for chunk in archive.iter_entry(name, [content]):
+            yield chunk
+
+    strings = {}
+    for chunk in archive.iter_entry(
+        'xl/worksheets/sheet1.xml', _iter_sheet(rows, strings)
+    ):
+        yield chunk
+    for chunk in archive.iter_entry(
+        'xl/sharedStrings.xml', _iter_shared_strings(strings)
+    ):
+        yield chunk
+
+    yield archive.close()
+
+
+SHEET_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+RELS_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+DOC_RELS_NS = (
+    '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+)
+
+# built-in number formats showing dates
+DATE_FORMAT_IDS = set(range(14, 23) + range(45, 48))
+
+_cell_ref_re = re.compile(r'^([A-Z]+)')
+_quoted_format_re = re.compile(r'"[^"]*"|\[[^\]]*\]')
+
+
+def _get_first_sheet_path(archive):
+    workbook = iterparse(archive.open('xl/workbook.xml'))
+    for event, element in workbook:
+        if element.tag == SHEET_NS + 'sheet':
+            sheet_rel = element.get(DOC_RELS_NS + 'id')
+            break
+    else:
+        raise ValueError('Workbook has no sheets')
+
+    rels = iterparse(archive.open('xl/_rels/workbook.xml.rels'))
+    for event, element in rels:
+        if (element.tag == RELS_NS + 'Relationship' and
+                element.get('Id') == sheet_rel):
+            target = element.get('Target')
+            if target.startswith('/'):
+                return target[1:]
+            return 'xl/' + target
+    raise ValueError('Sheet %s is not found' % sheet_rel)
+
+
+def _read_shared_strings(archive):
+    try:
+        source = archive.open('xl/sharedStrings.xml')
+    except KeyError:
+        return []
+
+    strings = []
+    for event, element in iterparse(source):
+        if element.tag == SHEET_NS + 'si':
+            # rich text is split into several runs
+            strings.append(u''.join(
+                text.text or u'' for text in element.iter(SHEET_NS + 't')
+            ))
+            element.clear()
+    return strings
+
+
+def _read_date_styles(archive):
+    try:
+        source = archive.open('xl/styles.xml')
+    except KeyError:
+        return set()
+
+    custom_formats = {}
+    date_styles = set()
+    in_cell_formats = False
+    style_index = 0
+    for event, element in iterparse(source, events=('start', 'end')):
+        if element.tag == SHEET_NS + 'numFmt' and event == 'end':
+            code = _quoted_format_re.sub('', element.get('formatCode', ''))
+            custom_formats[int(element.get('numFmtId'))] = any(
+                c in code.lower() for c in 'dmyhs'
+            )
+        elif element.tag == SHEET_NS + 'cellXfs':
+            in_cell_formats = event == 'start'
+        elif (in_cell_formats and element.tag == SHEET_NS + 'xf' and
+              event == 'start'):
+            format_id = int(element.get('numFmtId', 0))
+            if format_id in DATE_FORMAT_IDS or custom_formats.get(format_id):
+                date_styles.add(style_index)
+            style_index += 1
+    return date_styles
+
+
+def iter_xlsx_rows(fileobj):
+    """
+    Yields rows of the first sheet of an XLSX file as lists of values.
+
+    The sheet is parsed as a stream, only shared strings and styles are
+    loaded up front. Empty cells are None, numbers are floats and dates
+    are naive datetimes.
+    """
+    archive = zipfile.ZipFile(fileobj)
+    strings = _read_shared_strings(archive)
+    date_styles = _read_date_styles(archive)
+    shared_date = SharedDate()
+
+    row = []
+    for event, element in iterparse(
+        archive.open(_get_first_sheet_path(archive))
+    ):
+        if element.tag == SHEET_NS + 'c':
+            ref = element.get('r')
+            if ref:
+                column = column_index_from_string(
+                    _cell_ref_re.match(ref).group(1)
+                ) - 1
+            else:
+                column = len(row)
+
+            data_type = element.get('t', 'n')
+            if data_type == 'inlineStr':
+                value = u''.join(
+                    text.text or u'' for text in element.iter(SHEET_NS + 't')
+                )
+            else:
+                value = element.findtext(SHEET_NS + 'v')
+
+            if value is None or data_type == 'e':
+                value = None
+            elif data_type == 's':
+                value = strings[int(value)]
+            elif data_type == 'b':
+                value = value == '1'
+            elif data_type == 'n':
+                value = float(value)
+                if int(element.get('s', 0)) in date_styles:
+                    value = shared_date.from_julian(value)
+            elif data_type == 'str':
+                value = unicode(value)
+
+            row.extend([None] * (column - len(row)))
+            row.append(value)
+            element.clear()
+        elif element.tag == SHEET_NS + 'row':
+            yield row
+            row = []
+            element.clear()
+
+
+def _encode_csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, bool):
+        return int(value)
+    return unicode(value).encode('utf-8')
+
+
+def iter_csv(rows, batch_size=100):
+    """
+    Yields UTF-8 CSV of ``rows``, ``batch_size`` rows per chunk
+    """
+    buf = _StreamBuffer()
+    writer = csv.writer(buf)
+    for index, row in enumerate(rows, 1):
+        writer.writerow([_encode_csv_value(value) for value in row])
+        if index % batch_size == 0:
+            yield buf.pop()
+    yield buf.pop()
+
+
+def iter_jsonl(rows, batch_size=100):
+    """
+    Yields one JSON object per line, keyed by the first row of ``rows``
+    """
+    rows = iter(rows)
+    header = next(rows)
+    encoder = DjangoJSONEncoder(ensure_ascii=False)
+    lines = []
+    for row in rows:
+        lines.append(encoder.encode(OrderedDict(zip(header, row))))
+        if len(lines) == batch_size:
+            yield (u'\n'.join(lines) + u'\n').encode('utf-8')
+            lines = []
+    if lines:
+        yield (u'\n'.join(lines) + u'\n').encode('utf-8')
+
+
+def iter_gzip(chunks):
+    compressor = zlib.compressobj(
+        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS
+    )
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+TEXT_FORMATS = {
+    'csv': (iter_csv, 'text/csv; charset=utf-8'),
+    'jsonl': (iter_jsonl, 'application/x-ndjson; charset=utf-8'),
+}
+
+
+def get_text_response(rows, format, filename, compress=False):
+    """
+    Returns response streaming ``rows`` as CSV or JSON lines.
+
+    The rows are produced while the response is being sent, so memory
+    use does not depend on their number.
+    """
+    iter_text, content_type = TEXT_FORMATS[format]
+    content = iter_text(rows)
+    filename = '%s.%s' % (filename, format)
+    if compress:
+        content = iter_gzip(content)
+        content_type = 'application/gzip'
+        filename += '.gz'
+
+    response = HttpResponse(content, content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
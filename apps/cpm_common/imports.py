@@ -0,0 +1,205 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connection, models
+from django.utils import timezone, translation
+
+from apps.cpm_common.utils import chunks
+
+
+IMPORT_BATCH_SIZE = getattr(settings, 'IMPORT_BATCH_SIZE', 500)
+
+
+class InvalidImport(Exception):
+    pass
+
+
+class ModelImport(object):
+    """
+    Updates existing objects of ``model`` from rows of a spreadsheet.
+
+    The first row is a header of field names starting with ``id``. Rows
+    are processed in batches: objects of a batch are fetched with one
+    ``in_bulk`` query, choice labels are resolved through prebuilt
+    lookups, and only changed columns are written, with one UPDATE per
+    column and chunk of rows. ``run`` returns the changes as
+    ``(pk, [(field name, old value, new value), ...])`` items.
+    """
+    model = None
+    batch_size = IMPORT_BATCH_SIZE
+
+    def __init__(self, header):
+        header = list(header)
+        if not header or header[0] != 'id':
+            raise InvalidImport('First column must be id')
+
+        allowed_fields = dict(
+            (f.name, f) for f in self.model._meta.fields if f.editable
+        )
+        self.fields = []
+        for name in header[1:]:
+            if name not in allowed_fields:
+                raise InvalidImport('Invalid field %s' % name)
+            self.fields.append(allowed_fields[name])
+
+        self.choices = [self._get_choice_lookup(f) for f in self.fields]
+
+    def _get_choice_lookup(self, field):
+        if not field.choices:
+            return None
+
+        lookup = {}
+        current_lang = translation.get_language()
+        try:
+            # exports are made in English, labels of the admin's language
+            # are accepted as well
+            for lang in ('en', current_lang):
+                translation.activate(lang)
+                for key, label in field.flatchoices:
+                    lookup[unicode(label)] = key
+        finally:
+            translation.activate(current_lang)
+
+        for key, label in field.flatchoices:
+            lookup[key] = key
+        return lookup
+
+    def _convert(self, pk, field, lookup, value):
+        if lookup is not None:
+            try:
+                return lookup[value]
+            except (KeyError, TypeError):
+                raise InvalidImport('%s %s: invalid %s' % (
+                    self.model._meta.object_name, pk, field.name
+                ))
+
+        if value is None and not field.null and field.empty_strings_allowed:
+            return ''
+
+        if (isinstance(value, float) and value.is_integer() and
+                not isinstance(field, models.FloatField)):
+            # spreadsheets store all numbers as floats
+            value = int(value)
+
+        if (isinstance(value, datetime) and settings.USE_TZ and
+                timezone.is_naive(value)):
+            # dates are exported in UTC
+            value = timezone.make_aware(value, timezone.utc)
+
+        try:
+            return field.to_python(value)
+        except ValidationError as e:
+            raise InvalidImport('%s %s: invalid %s: %s' % (
+                self.model._meta.object_name, pk, field.name,
+                u' '.join(e.messages),
+            ))
+
+    def _is_same(self, old, new):
+        if isinstance(old, datetime) and isinstance(new, datetime):
+            # spreadsheets keep dates with millisecond precision
+            return abs(old - new) < timedelta(seconds=1)
+        return old == new
+
+    def run(self, rows, dry_run=False):
+        changes = []
+        batch = []
+        for row in rows:
+            if not any(value not in (None, '') for value in row):
+                continue
+
+            batch.append(row)
+            if len(batch) == self.batch_size:
+                changes.extend(self._run_batch(batch, dry_run))
+                batch = []
+
+        if batch:
+            changes.extend(self._run_batch(batch, dry_run))
+        return changes
+
+    def _run_batch(self, rows, dry_run):
+        pk_field = self.model._meta.pk
+        try:
+            pks = [pk_field.to_python(row[0]) for row in rows]
+        except ValidationError as e:
+            raise InvalidImport(u'Invalid id: %s' % u' '.join(e.messages))
+        objects = self.model.objects.in_bulk(pks)
+
+        changed = []
+        width = len(self.fields) + 1
+        for pk, row in zip(pks, rows):
+            try:
+                obj = objects[pk]
+            except KeyError:
+                raise InvalidImport('Unknown %s %s' % (
+                    self.model._meta.object_name, pk
+                ))
+
+            row = list(row) + [None] * (width - len(row))
+            changes = []
+            for field, lookup, value in zip(
+                self.fields, self.choices, row[1:]
+            ):
+                new = self._convert(pk, field, lookup, value)
+                old = getattr(obj, field.attname)
+                if not self._is_same(old, new):
+                    changes.append((field.name, old, new))
+
+            if changes:
+                changed.append((obj, changes))
+
+        if changed and not dry_run:
+            self.apply(changed)
+        return [(obj.pk, changes) for obj, changes in changed]
+
+    def apply(self, changed):
+        """
+        Saves ``(obj, changes)`` items and updates the objects in place
+        """
+        now = timezone.now()
+        auto_now = dict(
+            (f.name, now) for f in self.model._meta.fields
+            if getattr(f, 'auto_now', False)
+        )
+
+        columns = defaultdict(list)
+        for obj, changes in changed:
+            for name, old, new in changes:
+                columns[name].append((obj, new))
+
+        for name, values in columns.iteritems():
+            field = self.model._meta.get_field(name)
+            for chunk in chunks(values):
+                self._update_column(field, chunk)
+                for obj, value in chunk:
+                    setattr(obj, field.attname, value)
+
+        if auto_now:
+            for objects in chunks(obj for obj, changes in changed):
+                self.model.objects.filter(
+                    pk__in=[obj.pk for obj in objects]
+                ).update(**auto_now)
+                for obj in objects:
+                    for name, value in auto_now.iteritems():
+                        setattr(obj, name, value)
+
+    def _update_column(self, field, values):
+        # one UPDATE per column and chunk, each row gets its own value
+        qn = connection.ops.quote_name
+        pk_column = qn(self.model._meta.pk.column)
+        cases, params = [], []
+        for obj, value in values:
+            cases.append('WHEN %s THEN %s')
+            params.extend([
+                obj.pk, field.get_db_prep_save(value, connection=connection)
+            ])
+        params.extend(obj.pk for obj, value in values)
+
+        connection.cursor().execute(
+            'UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+                qn(self.model._meta.db_table), qn(field.column), pk_column,
+                ' '.join(cases), pk_column, ', '.join(['%s'] * len(values)),
+            ),
+            params
+        )
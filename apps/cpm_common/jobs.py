@@ -0,0 +1,307 @@
+import hashlib
+import importlib
+import json
+import logging
+import os
+import os.path
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core import signing
+from django.db.models import Count, Max
+from django.utils import timezone, translation
+
+from apps.cpm_common.export import (
+    XLSX_CONTENT_TYPE, iter_values, iter_xlsx, iter_zip
+)
+from apps.cpm_common.models import ExportJob
+from apps.cpm_common.utils import chunks
+
+logger = logging.getLogger('cpm_common.jobs')
+
+EXPORT_LINK_MAX_AGE = getattr(settings, 'EXPORT_LINK_MAX_AGE', 24 * 60 * 60)
+EXPORT_MAX_AGE = getattr(settings, 'EXPORT_MAX_AGE', 7 * 24 * 60 * 60)
+# pending or running jobs without progress for this long are taken for lost
+EXPORT_JOB_TIMEOUT = getattr(settings, 'EXPORT_JOB_TIMEOUT', 30 * 60)
+
+
+class Export(object):
+    """
+    File built in background by ``RunExportJob``.
+
+    Subclasses are referred to by dotted path, so a worker can find them
+    without any registration.
+    """
+    filename = 'export.xlsx'
+    content_type = XLSX_CONTENT_TYPE
+    progress_step = 500  # rows between progress updates
+    header = True  # the first row of iter_rows is not counted
+
+    def __init__(self, params):
+        self.params = params
+
+    def get_version(self):
+        """
+        Returns what a finished file may be reused for until it changes
+        """
+        return None
+
+    def get_total(self):
+        return None
+
+    def iter_rows(self):
+        raise NotImplementedError
+
+    def iter_content(self, rows):
+        return iter_xlsx(rows)
+
+
+class ModelExport(Export):
+    """
+    ``params['fields']`` columns of all ``model`` objects.
+
+    The model is expected to have an ``updated_at`` field maintained on
+    every change, it is used to reuse files of unchanged data.
+    """
+    model = None
+
+    def get_version(self):
+        stats = self.model.objects.aggregate(
+            count=Count('pk'), updated_at=Max('updated_at')
+        )
+        return '%(count)s:%(updated_at)s' % stats
+
+    def get_total(self):
+        return self.model.objects.count()
+
+    def iter_rows(self):
+        fields = self.params['fields']
+        yield fields
+
+        current_lang = translation.get_language()
+        try:
+            translation.activate('en')
+            for row in iter_values(self.model.objects.all(), fields):
+                yield row
+        finally:
+            translation.activate(current_lang)
+
+
+class ConfirmationsExport(Export):
+    """
+    ZIP of PDF confirmations of ``params['ids']`` submissions of
+    ``model``, files of failed ones are listed in failed.txt.
+
+    Rendering runs in a process pool of the worker, see
+    ``iter_confirmations``.
+    """
+    model = None
+    prefix = None
+    content_type = 'application/zip'
+    progress_step = 10
+    header = False
+
+    @property
+    def filename(self):
+        return '%s_pdf.zip' % self.prefix
+
+    def get_total(self):
+        return len(self.params['ids'])
+
+    def iter_confirmations(self, submissions):
+        """
+        Returns ``(submission, pdf)`` pairs, ``pdf`` is None if rendering
+        has failed
+        """
+        raise NotImplementedError
+
+    def _iter_submissions(self):
+        for chunk in chunks(sorted(self.params['ids'])):
+            for submission in self.model.objects.filter(
+                pk__in=chunk
+            ).order_by('id'):
+                yield submission
+
+    def iter_rows(self):
+        return self.iter_confirmations(self._iter_submissions())
+
+    def _iter_entries(self, rows):
+        failed = []
+        for submission, pdf in rows:
+            if pdf is None:
+                failed.append(submission)
+            else:
+                yield '%s_%d.pdf' % (self.prefix, submission.pk), pdf
+
+        if failed:
+            yield 'failed.txt', '\n'.join(
+                '%d %s' % (submission.pk, submission.title)
+                for submission in failed
+            ).encode('utf-8')
+
+    def iter_content(self, rows):
+        return iter_zip(self._iter_entries(rows))
+
+
+def get_export(job):
+    module_name, class_name = job.export.rsplit('.', 1)
+    export_class = getattr(importlib.import_module(module_name), class_name)
+    return export_class(json.loads(job.params))
+
+
+def fail_stale_exports():
+    """
+    Marks jobs pending or running without progress for
+    ``EXPORT_JOB_TIMEOUT`` as failed, their worker has crashed or the task
+    message was lost
+    """
+    now = timezone.now()
+    ExportJob.objects.filter(
+        status__in=[ExportJob.PENDING, ExportJob.RUNNING],
+        updated_at__lt=now - timedelta(seconds=EXPORT_JOB_TIMEOUT),
+    ).update(
+        status=ExportJob.FAILED,
+        error='Timed out',
+        updated_at=now,
+        finished_at=now,
+    )
+
+
+def start_export(export_path, params):
+    """
+    Returns a job building the export, an existing one if it can be reused
+
+    A finished job is reused while its file exists, a pending or running
+    one until it is ``EXPORT_JOB_TIMEOUT`` without progress.
+    """
+    params = json.dumps(params, sort_keys=True)
+    job = ExportJob(export=export_path, params=params)
+    version = get_export(job).get_version()
+    job.fingerprint = hashlib.sha1(
+        json.dumps([export_path, params, version])
+    ).hexdigest()
+
+    if version is not None:
+        fail_stale_exports()
+        since = timezone.now() - timedelta(seconds=EXPORT_MAX_AGE)
+        for existing in ExportJob.objects.filter(
+            fingerprint=job.fingerprint, created_at__gt=since
+        ).exclude(status=ExportJob.FAILED).order_by('-id')[:1]:
+            if existing.status != ExportJob.DONE or os.path.exists(
+                existing.file.path
+            ):
+                return existing
+
+    job.save()
+
+    from apps.cpm_common.tasks import RunExportJob
+    RunExportJob().apply_async(args=[job.id])
+    return job
+
+
+class LostExport(Exception):
+    pass
+
+
+def _update_running(job, **values):
+    # a job taken for lost by fail_stale_exports stays failed
+    return ExportJob.objects.filter(
+        pk=job.pk, status=ExportJob.RUNNING
+    ).update(updated_at=timezone.now(), **values)
+
+
+def _count_progress(job, rows, step, header):
+    for index, row in enumerate(rows, 0 if header else 1):
+        if index and index % step == 0:
+            if not _update_running(job, progress=index):
+                raise LostExport('Export %s has timed out' % job.pk)
+        yield row
+
+
+def run_export(job):
+    claimed = ExportJob.objects.filter(
+        pk=job.pk, status=ExportJob.PENDING
+    ).update(status=ExportJob.RUNNING, updated_at=timezone.now())
+    if not claimed:
+        return
+
+    export = get_export(job)
+    # the random directory keeps files from being guessed under MEDIA_URL
+    name = os.path.join(
+        job.file.field.upload_to, uuid.uuid4().hex, export.filename
+    )
+    path = os.path.join(settings.MEDIA_ROOT, name)
+    try:
+        total = export.get_total()
+        _update_running(job, total=total)
+
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            for chunk in export.iter_content(_count_progress(
+                job, export.iter_rows(), export.progress_step, export.header
+            )):
+                f.write(chunk)
+    except Exception as e:
+        logger.exception('Export %s failed' % job.pk)
+        _remove_file(path)
+        _update_running(
+            job,
+            status=ExportJob.FAILED,
+            error=unicode(e),
+            finished_at=timezone.now(),
+        )
+        raise
+
+    done = _update_running(
+        job,
+        status=ExportJob.DONE,
+        progress=total or 0,
+        file=name,
+        finished_at=timezone.now(),
+    )
+    if not done:
+        logger.error('Export %s has finished after timing out' % job.pk)
+        _remove_file(path)
+
+
+def _remove_file(path):
+    try:
+        os.unlink(path)
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        pass
+
+
+def clean_exports():
+    """
+    Removes jobs and files older than ``EXPORT_MAX_AGE``
+    """
+    fail_stale_exports()
+
+    since = timezone.now() - timedelta(seconds=EXPORT_MAX_AGE)
+    for job in ExportJob.objects.filter(created_at__lt=since):
+        if job.file:
+            _remove_file(job.file.path)
+        job.delete()
+
+
+def get_download_token(job):
+    return signing.dumps(job.pk, salt='cpm_common.jobs')
+
+
+def get_download_job(token):
+    """
+    Returns job of a download link, None if it is invalid or expired
+    """
+    try:
+        job_id = signing.loads(
+            token, salt='cpm_common.jobs', max_age=EXPORT_LINK_MAX_AGE
+        )
+    except signing.BadSignature:
+        return None
+
+    try:
+        return ExportJob.objects.get(pk=job_id, status=ExportJob.DONE)
+    except ExportJob.DoesNotExist:
+        return None
@@ -0,0 +1,146 @@
+import base64
+import cPickle as pickle
+import logging
+import smtplib
+import socket
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.db.models import Count, F, Min
+from django.utils import timezone
+
+from apps.cpm_common.models import QueuedEmail
+
+logger = logging.getLogger('cpm_common.mail')
+
+MAIL_BATCH_SIZE = getattr(settings, 'MAIL_BATCH_SIZE', 100)
+MAIL_MAX_ATTEMPTS = getattr(settings, 'MAIL_MAX_ATTEMPTS', 5)
+MAIL_RATE_LIMIT = getattr(settings, 'MAIL_RATE_LIMIT', 30)
+MAIL_DOMAIN_RATE_LIMITS = getattr(settings, 'MAIL_DOMAIN_RATE_LIMITS', {})
+
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, socket.error)
+
+
+def _get_domain(message):
+    recipients = message.recipients()
+    if not recipients:
+        return ''
+    return recipients[0].rpartition('@')[2].strip('> ').lower()
+
+
+def queue_email(message):
+    """
+    Stores message in the outgoing queue, DispatchMail sends it from
+    celerybeat
+    """
+    QueuedEmail.objects.create(
+        domain=_get_domain(message),
+        message=base64.b64encode(pickle.dumps(message, 2)),
+    )
+
+
+class MailDispatcher(object):
+    """
+    Sends queued email in batches over one SMTP connection.
+
+    The connection is kept open between batches and reopened once per
+    message if the server has dropped it. Every recipient domain may get
+    at most ``MAIL_DOMAIN_RATE_LIMITS.get(domain, MAIL_RATE_LIMIT)``
+    messages a minute; the rest is left in the queue for the next run,
+    so a backlog to one domain doesn't hold up mail to others.
+    """
+    def __init__(self, connection_factory=get_connection,
+                 batch_size=MAIL_BATCH_SIZE):
+        self.connection_factory = connection_factory
+        self.batch_size = batch_size
+        self._connection = None
+
+    def _open(self):
+        if self._connection is None:
+            self._connection = self.connection_factory()
+        self._connection.open()
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except CONNECTION_ERRORS + (AttributeError,):
+                # the smtp backend fails on close() if open() did not succeed
+                pass
+            self._connection = None
+
+    def _send(self, message):
+        try:
+            sent = self._open().send_messages([message])
+        except CONNECTION_ERRORS:
+            logger.info('SMTP connection lost, reconnecting')
+            self.close()
+            sent = self._open().send_messages([message])
+
+        if not sent:
+            raise smtplib.SMTPException('Message was not sent')
+
+    def _get_allowance(self, now):
+        recently_sent = QueuedEmail.objects.filter(
+            sent_at__gt=now - timedelta(minutes=1)
+        ).values('domain').annotate(count=Count('id'))
+
+        sent = dict((row['domain'], row['count']) for row in recently_sent)
+        return lambda domain: MAIL_DOMAIN_RATE_LIMITS.get(
+            domain, MAIL_RATE_LIMIT
+        ) - sent.get(domain, 0)
+
+    def _get_batch(self, pending, now):
+        """
+        Returns up to ``batch_size`` pending messages, no more for a domain
+        than it may get now, domains with the oldest mail go first
+        """
+        allowance = self._get_allowance(now)
+        domains = pending.values('domain').annotate(
+            first=Min('id')
+        ).order_by('first')
+
+        batch = []
+        for row in domains.iterator():
+            size = min(
+                allowance(row['domain']), self.batch_size - len(batch)
+            )
+            if size > 0:
+                batch.extend(pending.filter(domain=row['domain'])[:size])
+            if len(batch) >= self.batch_size:
+                break
+        return sorted(batch, key=lambda queued: queued.pk)
+
+    def drain(self):
+        """
+        Sends one batch, returns the number of messages left in the queue
+        """
+        pending = QueuedEmail.objects.filter(
+            sent_at=None, attempts__lt=MAIL_MAX_ATTEMPTS
+        ).order_by('id')
+
+        now = timezone.now()
+        for queued in self._get_batch(pending, now):
+            # claiming the row first keeps concurrent runs from sending twice
+            claimed = QueuedEmail.objects.filter(
+                pk=queued.pk, sent_at=None
+            ).update(sent_at=now)
+            if not claimed:
+                continue
+
+            try:
+                self._send(pickle.loads(base64.b64decode(queued.message)))
+            except Exception as e:
+                logger.exception('Failed to send queued email %s' % queued.pk)
+                QueuedEmail.objects.filter(pk=queued.pk).update(
+                    sent_at=None,
+                    attempts=F('attempts') + 1,
+                    last_error=unicode(e),
+                )
+
+        return pending.count()
+
+
+dispatcher = MailDispatcher()
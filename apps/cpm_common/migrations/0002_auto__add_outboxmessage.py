@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'OutboxMessage'
+        db.create_table('cpm_common_outboxmessage', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('task', self.gf('django.db.models.fields.CharField')(max_length=255)),
+            ('payload', self.gf('django.db.models.fields.TextField')()),
+            ('created_at', self.gf('django.db.models.fields.DateTimeField')(auto_now_add=True, blank=True)),
+            ('relayed_at', self.gf('django.db.models.fields.DateTimeField')(db_index=True, null=True, blank=True)),
+            ('attempts', self.gf('django.db.models.fields.IntegerField')(default=0)),
+            ('last_error', self.gf('django.db.models.fields.TextField')(blank=True)),
+        ))
+        db.send_create_signal('cpm_common', ['OutboxMessage'])
+
+
+    def backwards(self, orm):
+        # Deleting model 'OutboxMessage'
+        db.delete_table('cpm_common_outboxmessage')
+
+
+    models = {
+        'cpm_common.outboxmessage': {
+            'Meta': {'object_name': 'OutboxMessage'},
+            'attempts': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'created_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_error': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'payload': ('django.db.models.fields.TextField', [], {}),
+            'relayed_at': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            'task': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        'cpm_common.queuedemail': {
+            'Meta': {'object_name': 'QueuedEmail'},
+            'attempts': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'created_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'domain': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_error': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'message': ('django.db.models.fields.TextField', [], {}),
+            'sent_at': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['cpm_common']
\ No newline at end of file
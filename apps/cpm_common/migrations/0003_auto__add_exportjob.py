@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'ExportJob'
+        db.create_table('cpm_common_exportjob', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('export', self.gf('django.db.models.fields.CharField')(max_length=255)),
+            ('params', self.gf('django.db.models.fields.TextField')()),
+            ('fingerprint', self.gf('django.db.models.fields.CharField')(max_length=40, db_index=True)),
+            ('status', self.gf('django.db.models.fields.IntegerField')(default=0)),
+            ('progress', self.gf('django.db.models.fields.IntegerField')(default=0)),
+            ('total', self.gf('django.db.models.fields.IntegerField')(null=True)),
+            ('file', self.gf('django.db.models.fields.files.FileField')(max_length=255, blank=True)),
+            ('error', self.gf('django.db.models.fields.TextField')(blank=True)),
+            ('created_at', self.gf('django.db.models.fields.DateTimeField')(auto_now_add=True, blank=True)),
+            ('finished_at', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True)),
+        ))
+        db.send_create_signal('cpm_common', ['ExportJob'])
+
+
+    def backwards(self, orm):
+        # Deleting model 'ExportJob'
+        db.delete_table('cpm_common_exportjob')
+
+
+    models = {
+        'cpm_common.exportjob': {
+            'Meta': {'object_name': 'ExportJob'},
+            'created_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'error': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'export': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'file': ('django.db.models.fields.files.FileField', [], {'max_length': '255', 'blank': 'True'}),
+            'fingerprint': ('django.db.models.fields.CharField', [], {'max_length': '40', 'db_index': 'True'}),
+            'finished_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'params': ('django.db.models.fields.TextField', [], {}),
+            'progress': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'status': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'total': ('django.db.models.fields.IntegerField', [], {'null': 'True'})
+        },
+        'cpm_common.outboxmessage': {
+            'Meta': {'object_name': 'OutboxMessage'},
+            'attempts': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'created_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_error': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'payload': ('django.db.models.fields.TextField', [], {}),
+            'relayed_at': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            'task': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        'cpm_common.queuedemail': {
+            'Meta': {'object_name': 'QueuedEmail'},
+            'attempts': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'created_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'domain': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_error': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'message': ('django.db.models.fields.TextField', [], {}),
+            'sent_at': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['cpm_common']
\ No newline at end of file
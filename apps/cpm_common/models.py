@@ -1,3 +1,108 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.utils.translation import ugettext_lazy as _
 
-# Create your models here.
+
+class QueuedEmail(models.Model):
+    domain = models.CharField(verbose_name=_('Recipient domain'),
+                              max_length=255, db_index=True)
+    message = models.TextField(verbose_name=_('Pickled message'))
+    created_at = models.DateTimeField(
+        auto_now_add=True, verbose_name=_('Created at'))
+    sent_at = models.DateTimeField(
+        null=True, blank=True, db_index=True, verbose_name=_('Sent at'))
+    attempts = models.IntegerField(verbose_name=_('Attempts'), default=0)
+    last_error = models.TextField(verbose_name=_('Last error'), blank=True)
+
+    def __unicode__(self):
+        return 'Email %s to %s' % (self.id, self.domain)
+
+
+class OutboxMessage(models.Model):
+    task = models.CharField(verbose_name=_('Task'), max_length=255)
+    payload = models.TextField(verbose_name=_('Pickled arguments'))
+    created_at = models.DateTimeField(
+        auto_now_add=True, verbose_name=_('Created at'))
+    relayed_at = models.DateTimeField(
+        null=True, blank=True, db_index=True, verbose_name=_('Relayed at'))
+    attempts = models.IntegerField(verbose_name=_('Attempts'), default=0)
+    last_error = models.TextField(verbose_name=_('Last error'), blank=True)
+
+    def __unicode__(self):
+        return 'Outbox message %s for %s' % (self.id, self.task)
+
+
+class ExportJob(models.Model):
+    PENDING = 0
+    RUNNING = 1
+    DONE = 2
+    FAILED = 3
+
+    STATUS_CHOICES = (
+        (PENDING, _('Pending')),
+        (RUNNING, _('Running')),
+        (DONE, _('Done')),
+        (FAILED, _('Failed')),
+    )
+
+    export = models.CharField(verbose_name=_('Export'), max_length=255)
+    params = models.TextField(verbose_name=_('Parameters'))
+    fingerprint = models.CharField(
+        verbose_name=_('Fingerprint'), max_length=40, db_index=True)
+    status = models.IntegerField(verbose_name=_('Status'),
+                                 choices=STATUS_CHOICES, default=PENDING)
+    progress = models.IntegerField(verbose_name=_('Progress'), default=0)
+    total = models.IntegerField(verbose_name=_('Total'), null=True)
+    file = models.FileField(
+        verbose_name=_('File'), upload_to='exports', max_length=255,
+        blank=True)
+    error = models.TextField(verbose_name=_('Error'), blank=True)
+    created_at = models.DateTimeField(
+        auto_now_add=True, verbose_name=_('Created at'))
+    # set on every status or progress change, a job left unchanged for
+    # too long is taken for lost
+    updated_at = models.DateTimeField(
+        auto_now=True, verbose_name=_('Updated at'))
+    finished_at = models.DateTimeField(
+        null=True, blank=True, verbose_name=_('Finished at'))
+
+    def __unicode__(self):
+        return 'Export %s of %s' % (self.id, self.export)
+
+
+class CacheVersion(models.Model):
+    """
+    Version of cached data shared by all processes, bumped when the data
+    changes and put into cache keys, so stale entries are never read
+    """
+    key = models.CharField(verbose_name=_('Key'), max_length=100,
+                           unique=True)
+    version = models.IntegerField(verbose_name=_('Version'), default=0)
+
+    def __unicode__(self):
+        return '%s %s' % (self.key, self.version)
+
+    @classmethod
+    def get(cls, key):
+        versions = cls.objects.filter(key=key).values_list(
+            'version', flat=True
+        )[:1]
+        return versions[0] if versions else 0
+
+    @classmethod
+    def bump(cls, key):
+        if cls.objects.filter(key=key).update(
+            version=models.F('version') + 1
+        ):
+            return
+
+        sid = transaction.savepoint()
+        try:
+            cls.objects.create(key=key, version=1)
+        except IntegrityError:
+            # created by a concurrent bump
+            transaction.savepoint_rollback(sid)
+            cls.objects.filter(key=key).update(
+                version=models.F('version') + 1
+            )
+        else:
+            transaction.savepoint_commit(sid)
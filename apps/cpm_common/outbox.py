@@ -0,0 +1,108 @@
+import base64
+import cPickle as pickle
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from apps.cpm_common.models import OutboxMessage
+
+logger = logging.getLogger('cpm_common.outbox')
+
+OUTBOX_BATCH_SIZE = getattr(settings, 'OUTBOX_BATCH_SIZE', 100)
+OUTBOX_MAX_ATTEMPTS = getattr(settings, 'OUTBOX_MAX_ATTEMPTS', 5)
+OUTBOX_MAX_AGE = getattr(
+    settings, 'OUTBOX_MAX_AGE', 7 * 24 * 60 * 60  # seconds
+)
+
+
+def enqueue_task(task, args=(), kwargs=None):
+    """
+    Stores a task call in the outbox.
+
+    Nothing is sent to the broker here, so the call belongs to the
+    surrounding database transaction: it is relayed only if that commits.
+    """
+    OutboxMessage.objects.create(
+        task=task.name,
+        payload=base64.b64encode(pickle.dumps((args, kwargs or {}), 2)),
+    )
+
+
+class OutboxRelay(object):
+    """
+    Publishes outbox messages to the broker in batches.
+
+    A message is marked as relayed only after it has been published, so
+    a crash in between makes it go out twice rather than never; tasks
+    sent through the outbox should tolerate that. When the broker is
+    unavailable the batch stops and the rest waits for the next run.
+    Any other failure is counted against the message alone, which is
+    skipped and given up after ``OUTBOX_MAX_ATTEMPTS``.
+    """
+    def __init__(self, batch_size=OUTBOX_BATCH_SIZE):
+        self.batch_size = batch_size
+
+    def relay(self):
+        """
+        Relays one batch, returns the number of published messages
+        """
+        from celery import current_app
+
+        batch = list(OutboxMessage.objects.filter(
+            relayed_at=None, attempts__lt=OUTBOX_MAX_ATTEMPTS
+        ).order_by('id')[:self.batch_size])
+        if not batch:
+            return 0
+
+        relayed = 0
+
+        with current_app.producer_or_acquire() as producer:
+            broker_errors = (
+                producer.connection.connection_errors +
+                producer.connection.channel_errors
+            )
+            for message in batch:
+                try:
+                    args, kwargs = pickle.loads(
+                        base64.b64decode(message.payload)
+                    )
+                    current_app.tasks[message.task].apply_async(
+                        args=args, kwargs=kwargs, producer=producer
+                    )
+                except broker_errors as e:
+                    logger.exception('Broker is unavailable')
+                    OutboxMessage.objects.filter(pk=message.pk).update(
+                        last_error=unicode(e),
+                    )
+                    break
+                except Exception as e:
+                    logger.exception(
+                        'Failed to relay outbox message %s' % message.pk
+                    )
+                    OutboxMessage.objects.filter(pk=message.pk).update(
+                        attempts=F('attempts') + 1,
+                        last_error=unicode(e),
+                    )
+                    continue
+
+                OutboxMessage.objects.filter(pk=message.pk).update(
+                    relayed_at=timezone.now()
+                )
+                relayed += 1
+
+        return relayed
+
+
+def clean_outbox():
+    """
+    Removes messages relayed more than ``OUTBOX_MAX_AGE`` ago
+    """
+    OutboxMessage.objects.filter(
+        relayed_at__lt=timezone.now() - timedelta(seconds=OUTBOX_MAX_AGE)
+    ).delete()
+
+
+relay = OutboxRelay()
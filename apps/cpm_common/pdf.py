@@ -0,0 +1,279 @@
+import glob
+import io
+import operator
+import os
+import os.path
+import tempfile
+import threading
+from cStringIO import StringIO
+
+from django.conf import settings
+from django.utils import translation
+
+
+PDF_FONT_PATH = getattr(settings, 'PDF_FONT_PATH', ['/usr/share/fonts/TTF/'])
+PDF_CACHE_DIR = getattr(
+    settings, 'PDF_CACHE_DIR',
+    os.path.join(tempfile.gettempdir(), 'filmfest_pdf')
+)
+PDF_CACHE_MAX_SIZE = getattr(settings, 'PDF_CACHE_MAX_SIZE', 100 * 1024 * 1024)
+
+
+def escape_rst(value):
+    """
+    Escapes all characters but spaces, so user input is never taken for
+    RST markup. Lines are separated by blank lines to keep them apart.
+    """
+    lines = []
+    for line in unicode(value).split(u'\n'):
+        line = line.strip()
+        if line:
+            # docutils drops escaped spaces, so spaces are left bare
+            line = (u'\\' + u'\\'.join(line)).replace(u'\\ ', u' ')
+        lines.append(line)
+    return u'\n\n'.join(lines)
+
+
+def _get_heading(title):
+    title = unicode(title)
+    return u'\n%s\n%s\n\n' % (title, '-' * len(title))
+
+
+def _get_value_getter(field):
+    getter = operator.attrgetter(field.name)
+    if not field.choices:
+        return getter
+
+    display = dict((key, unicode(label)) for key, label in field.flatchoices)
+    def get_display(obj):
+        value = getter(obj)
+        return display.get(value, value)
+    return get_display
+
+
+class ReportTemplate(object):
+    """
+    Report layout compiled for the currently active language.
+
+    Field labels, choice displays and the RST header are resolved once,
+    so producing a document is a single pass over prepared value getters.
+    """
+    def __init__(self, header, model, sections, permissions):
+        self.head, self.tail = (header % {'sections': '\0'}).split('\0')
+
+        get_field = lambda name: model._meta.get_field_by_name(name)[0]
+        self.sections = []
+        for title, names in sections:
+            fields = [get_field(name) for name in names]
+            self.sections.append((_get_heading(title), [
+                (
+                    u'* %s\n    ' % unicode(field.verbose_name),
+                    _get_value_getter(field),
+                ) for field in fields
+            ]))
+
+        title, names = permissions
+        self.permissions_heading = _get_heading(title)
+        self.permissions = [
+            (
+                u'* ' + escape_rst(get_field(name).verbose_name),
+                operator.attrgetter(name),
+            ) for name in names
+        ]
+
+    def render(self, obj):
+        sections_rst = []
+        for heading, items in self.sections:
+            values = [(prefix, getter(obj)) for prefix, getter in items]
+            if not any(value for prefix, value in values):
+                continue
+
+            sections_rst.append(heading + u'\n'.join(
+                prefix + escape_rst(value).replace(u'\n', u'\n    ')
+                for prefix, value in values
+                if not (value is None or value == '')
+            ))
+
+        permissions = [
+            label for label, getter in self.permissions if getter(obj) == 1
+        ]
+        if permissions:
+            sections_rst.append(
+                self.permissions_heading + u'\n\n'.join(permissions)
+            )
+
+        return self.head + u'\n'.join(sections_rst) + self.tail
+
+
+class ReportRenderer(object):
+    """
+    rst2pdf renderer which is set up only once per process.
+
+    Parsing the stylesheet and scanning the font directories takes much
+    longer than rendering a one page confirmation, so the ``RstToPdf``
+    instance and a ``ReportTemplate`` per language are kept between calls.
+    Call ``warm()`` at worker start to pay that price before the first task.
+    """
+    def __init__(self, docs, headers, default_lang, stylesheet,
+                 model, sections, permissions):
+        self.docs = docs
+        self.headers = headers
+        self.default_lang = default_lang
+        self.stylesheet = stylesheet
+        self.model = model
+        self.sections = sections
+        self.permissions = permissions
+
+        self._lock = threading.RLock()
+        self._pdf_creator = None
+        self._templates = {}
+
+    def warm(self):
+        with self._lock:
+            if self._pdf_creator is None:
+                self._load()
+
+    def _load(self):
+        from rst2pdf.createpdf import RstToPdf
+
+        current_lang = translation.get_language()
+        try:
+            for lang, filename in self.headers.iteritems():
+                rst_path = os.path.join(self.docs, filename)
+                with io.open(rst_path, encoding='utf-8') as rst_head:
+                    header = rst_head.read()
+
+                translation.activate(lang)
+                self._templates[lang] = ReportTemplate(
+                    header, self.model, self.sections, self.permissions
+                )
+        finally:
+            translation.activate(current_lang)
+
+        # reportlab embeds TrueType fonts as subsets of the used glyphs,
+        # so page compression is what is left to make the files smaller
+        self._pdf_creator = RstToPdf(
+            stylesheets=[os.path.join(self.docs, self.stylesheet)],
+            font_path=PDF_FONT_PATH,
+            breaklevel=0,
+        )
+        # headers use ###Total### in the footer, which needs two passes;
+        # without this the first document is written out twice
+        self._pdf_creator.mustMultiBuild = True
+
+    def get_rst(self, obj, lang):
+        self.warm()
+        template = self._templates.get(
+            lang, self._templates[self.default_lang]
+        )
+        return template.render(obj)
+
+    def render(self, rst_data):
+        self.warm()
+
+        pdf_content = StringIO()
+        with self._lock:
+            # RstToPdf keeps the document state on the instance
+            self._pdf_creator.createPdf(
+                text=rst_data, output=pdf_content, compressed=True
+            )
+        return pdf_content.getvalue()
+
+
+class PdfCache(object):
+    """
+    Disk-backed cache of rendered documents.
+
+    Keys are expected to contain a hash of everything the document is
+    rendered from, so a changed object never hits a stale file. Files are
+    named ``<key>.pdf``; keys shaped as ``<object>-<hash>-<variant>`` let
+    ``invalidate`` drop outdated documents of one object at once. When the
+    directory grows over ``max_size`` bytes the least recently used files
+    are removed.
+    """
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    def _path(self, key):
+        return os.path.join(self.directory, '%s.pdf' % key)
+
+    def open(self, key):
+        """
+        Returns cached file opened for reading, or None on a miss
+        """
+        path = self._path(key)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return f
+
+    def get(self, key):
+        f = self.open(key)
+        if f is None:
+            return None
+
+        with f:
+            return f.read()
+
+    def set(self, key, content):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.rename(tmp_path, self._path(key))
+        except:
+            os.unlink(tmp_path)
+            raise
+
+        self._evict()
+
+    def invalidate(self, prefix, keep=None):
+        """
+        Removes files of ``prefix`` except ones keyed ``<prefix>-<keep>-...``
+        """
+        kept = keep and '%s-%s-' % (prefix, keep)
+        for path in glob.glob(os.path.join(self.directory, '%s-*.pdf' % prefix)):
+            if kept and os.path.basename(path).startswith(kept):
+                continue
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def _evict(self):
+        entries = []
+        total_size = 0
+        for path in glob.glob(os.path.join(self.directory, '*.pdf')):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total_size -= size
+
+
+pdf_cache = PdfCache(PDF_CACHE_DIR, PDF_CACHE_MAX_SIZE)
@@ -0,0 +1,48 @@
+import logging
+
+from celery import Task
+
+from apps.cpm_common.jobs import clean_exports, run_export
+from apps.cpm_common.mail import dispatcher
+from apps.cpm_common.models import ExportJob
+from apps.cpm_common.outbox import clean_outbox, relay
+
+logger = logging.getLogger('cpm_common.tasks')
+
+
+class DispatchMail(Task):
+    def run(self):
+        left = dispatcher.drain()
+        if left:
+            logger.info('DispatchMail: %d messages left' % left)
+
+
+class RelayOutbox(Task):
+    def run(self):
+        total = 0
+        while True:
+            relayed = relay.relay()
+            total += relayed
+            # a short batch means the outbox is empty, a message failed
+            # or the broker is down, whatever is left waits for beat
+            if relayed < relay.batch_size:
+                break
+
+        if total:
+            logger.info('RelayOutbox: %d messages relayed' % total)
+
+
+class CleanOutbox(Task):
+    def run(self):
+        clean_outbox()
+
+
+class RunExportJob(Task):
+    def run(self, job_id):
+        logger.info('RunExportJob %s' % job_id)
+        run_export(ExportJob.objects.get(pk=job_id))
+
+
+class CleanExports(Task):
+    def run(self):
+        clean_exports()
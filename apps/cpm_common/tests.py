@@ -1,12 +1,27 @@
+# -*- coding: utf-8 -*-
 """
 This file demonstrates writing tests using the unittest module. These will pass
 when you run "manage.py test".
 
 Replace this with more appropriate tests for your application.
 """
+import asyncore
+import datetime
+import random
+import smtpd
+import threading
+import time
+from cStringIO import StringIO
+from decimal import Decimal
 
+from django.core.mail import EmailMessage, get_connection
 from django.test import TestCase
 
+from apps.cpm_common import mail
+from apps.cpm_common.export import iter_xlsx, iter_xlsx_rows
+from apps.cpm_common.models import QueuedEmail
+from apps.cpm_common.pdf import escape_rst
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,3 +29,179 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+def _old_escape_rst(value):
+    # the per-year implementation escape_rst replaced
+    lines = []
+    for line in unicode(value).split('\n'):
+        lines.append(
+            ''.join(
+                '\%s' % c if c != ' ' else c for\
+                c in line.strip()
+            )
+        )
+    return '\n\n'.join(lines)
+
+
+def _get_synopsis(size, seed=0):
+    rnd = random.Random(seed)
+    alphabet = (
+        u'абвгдеёжзийклмнопрстуфхцчшщъыьэюя ' * 3 +
+        u'*_`|\\:.-=#<>[](){}!?\'" \t' + u'\n'
+    )
+    return u''.join(rnd.choice(alphabet) for i in xrange(size))
+
+
+class EscapeRstTest(TestCase):
+    def test_same_as_old_escaping(self):
+        values = [
+            u'', u' ', u'\n', u'plain text', u'  padded  ',
+            u'*bold* _link_ `code` |sub| \\ back\\slash',
+            u'.. directive::\n\n   indented\n- item\n\n\n',
+            u'Title\n=====\n', u'\r\nwindows\r\nlines\r\n',
+        ] + [_get_synopsis(2000, seed) for seed in range(10)]
+        for value in values:
+            self.assertEqual(escape_rst(value), _old_escape_rst(value))
+
+
+class XlsxTest(TestCase):
+    def _round_trip(self, rows):
+        return list(iter_xlsx_rows(StringIO(''.join(iter_xlsx(rows)))))
+
+    def test_round_trip(self):
+        rows = [
+            [u'title', u'length', u'ratio', u'submitted', u'accepted'],
+            [u'Фильм <1> & "2"', 12, 0.5, datetime.datetime(2014, 3, 1, 10),
+             True],
+            [u'film', Decimal('1.25'), -3.0, None, False],
+        ]
+        self.assertEqual(self._round_trip(rows), [
+            rows[0],
+            [u'Фильм <1> & "2"', 12.0, 0.5, datetime.datetime(2014, 3, 1, 10),
+             True],
+            [u'film', 1.25, -3.0, None, False],
+        ])
+
+    def test_gaps_before_new_columns(self):
+        rows = [['a', None], [None, None, 'x'], [], [None, 'y']]
+        self.assertEqual(
+            self._round_trip(rows),
+            [['a'], [None, None, 'x'], [], [None, 'y']]
+        )
+
+    def test_non_finite_numbers_as_text(self):
+        rows = [[float('nan'), float('inf'), Decimal('-Infinity'), 1.5]]
+        self.assertEqual(
+            self._round_trip(rows), [[u'nan', u'inf', u'-Infinity', 1.5]]
+        )
+
+
+class _SMTPServer(smtpd.SMTPServer):
+    """
+    Local SMTP stand-in counting connections and received messages
+    """
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.connections = 0
+        self.channels = []
+        self.recipients = []
+
+    def handle_accept(self):
+        conn, addr = self.accept()
+        self.connections += 1
+        self.channels.append(smtpd.SMTPChannel(self, conn, addr))
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.recipients.extend(rcpttos)
+
+    def drop(self):
+        for channel in self.channels:
+            channel.close()
+        self.channels = []
+
+
+class MailDispatcherTest(TestCase):
+    def setUp(self):
+        self.server = _SMTPServer()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.start()
+
+        self.dispatcher = mail.MailDispatcher(
+            connection_factory=lambda: get_connection(
+                'django.core.mail.backends.smtp.EmailBackend',
+                host='127.0.0.1', port=self.server.port,
+            ),
+            batch_size=4,
+        )
+
+    def tearDown(self):
+        self.dispatcher.close()
+        self.stopped.set()
+        self.thread.join()
+        self.server.drop()
+        self.server.close()
+
+    def _serve(self):
+        while not self.stopped.is_set():
+            asyncore.loop(timeout=0.01, count=1)
+
+    def _queue(self, *recipients):
+        for recipient in recipients:
+            mail.queue_email(EmailMessage(
+                'Subject', 'Body', 'no-reply@filmfest.by', [recipient]
+            ))
+
+    def _set_limits(self, rate_limit, domain_rate_limits):
+        old = mail.MAIL_RATE_LIMIT, mail.MAIL_DOMAIN_RATE_LIMITS
+
+        def restore():
+            mail.MAIL_RATE_LIMIT, mail.MAIL_DOMAIN_RATE_LIMITS = old
+        self.addCleanup(restore)
+
+        mail.MAIL_RATE_LIMIT = rate_limit
+        mail.MAIL_DOMAIN_RATE_LIMITS = domain_rate_limits
+
+    def test_batch_over_one_connection(self):
+        self._queue('a@one.by', 'b@two.by', 'c@one.by', 'd@three.by')
+
+        self.assertEqual(self.dispatcher.drain(), 0)
+        self.assertEqual(
+            self.server.recipients,
+            ['a@one.by', 'b@two.by', 'c@one.by', 'd@three.by']
+        )
+        self.assertEqual(self.server.connections, 1)
+        self.assertFalse(QueuedEmail.objects.filter(sent_at=None).exists())
+
+    def test_reconnect_after_server_drops(self):
+        self._queue('a@one.by', 'b@two.by')
+        self.assertEqual(self.dispatcher.drain(), 0)
+
+        self.server.drop()
+        time.sleep(0.1)
+
+        self._queue('c@one.by', 'd@two.by')
+        self.assertEqual(self.dispatcher.drain(), 0)
+        self.assertEqual(len(self.server.recipients), 4)
+        self.assertEqual(self.server.connections, 2)
+        self.assertFalse(
+            QueuedEmail.objects.filter(attempts__gt=0).exists()
+        )
+
+    def test_domain_limit(self):
+        self._set_limits(10, {'gmail.com': 2})
+        self._queue(*['user%d@gmail.com' % i for i in range(5)])
+        self._queue('a@one.by', 'b@two.by', 'c@three.by')
+
+        # a gmail.com backlog doesn't keep other domains out of the batch
+        self.assertEqual(self.dispatcher.drain(), 4)
+        self.assertEqual(
+            self.server.recipients,
+            ['user0@gmail.com', 'user1@gmail.com', 'a@one.by', 'b@two.by']
+        )
+
+        self.assertEqual(self.dispatcher.drain(), 3)
+        self.assertEqual(self.server.recipients[-1], 'c@three.by')
+        self.assertEqual(len(self.server.recipients), 5)
@@ -0,0 +1,183 @@
+from collections import defaultdict
+
+from django.conf import settings
+from django.utils import translation
+
+from apps.cpm_common.utils import chunks
+
+
+# languages tried after the active one, LANGUAGE_CODE and then the rest
+# of LANGUAGES if not set
+LANGUAGE_FALLBACKS = getattr(settings, 'LANGUAGE_FALLBACKS', None)
+
+
+def get_language_fallbacks(language_code=None):
+    """
+    Returns languages to look a translation up in: the given or active
+    language, then LANGUAGE_FALLBACKS
+    """
+    codes = [language_code or translation.get_language()]
+    if LANGUAGE_FALLBACKS is not None:
+        codes.extend(LANGUAGE_FALLBACKS)
+    else:
+        codes.append(settings.LANGUAGE_CODE)
+        codes.extend(code for code, _name in settings.LANGUAGES)
+
+    fallbacks = []
+    for code in codes:
+        if code not in fallbacks:
+            fallbacks.append(code)
+    return fallbacks
+
+
+class TranslationResolver(object):
+    """
+    Finds the best translation of objects, the one in the first of
+    ``languages`` they are translated into.
+
+    Translations are fetched with one query per translations model and
+    few hundred objects, and remembered, so resolving the same objects
+    again costs nothing. See ``get_translation_resolver`` for one
+    resolver per request.
+    """
+    def __init__(self, languages=None):
+        self.languages = languages or get_language_fallbacks()
+        self._resolved = {}
+
+    def resolve(self, objects, translations_model, fk_name,
+                language_field='language'):
+        """
+        Returns the best translation of every object by its pk, None for
+        objects without translations
+
+        ``fk_name`` is the foreign key from ``translations_model`` to the
+        objects, ``language_field`` holds the language of a translation.
+        """
+        fk_attname = translations_model._meta.get_field(fk_name).attname
+        pks = set(obj.pk for obj in objects)
+        missing = [
+            pk for pk in pks if (translations_model, pk) not in self._resolved
+        ]
+
+        for chunk in chunks(sorted(missing)):
+            found = {}
+            for trans in translations_model.objects.filter(**{
+                '%s__in' % fk_name: chunk,
+                '%s__in' % language_field: self.languages,
+            }):
+                found[
+                    getattr(trans, fk_attname), getattr(trans, language_field)
+                ] = trans
+
+            for pk in chunk:
+                self._resolved[translations_model, pk] = next((
+                    found[pk, language_code]
+                    for language_code in self.languages
+                    if (pk, language_code) in found
+                ), None)
+
+        return dict(
+            (pk, self._resolved[translations_model, pk]) for pk in pks
+        )
+
+    def assign(self, objects, translations_model, fk_name,
+               language_field='language', attname='translation'):
+        """
+        Sets ``attname`` of the objects to their best translation, which
+        fills ``translation`` cached properties of the models
+        """
+        objects = list(objects)
+        resolved = self.resolve(objects, translations_model, fk_name,
+                                language_field)
+        for obj in objects:
+            obj.__dict__[attname] = resolved[obj.pk]
+        return objects
+
+
+def get_translation_resolver(request):
+    """
+    Returns the resolver of the request for the active language
+    """
+    if not hasattr(request, '_translation_resolvers'):
+        request._translation_resolvers = {}
+
+    language_code = translation.get_language()
+    if language_code not in request._translation_resolvers:
+        request._translation_resolvers[language_code] = TranslationResolver(
+            get_language_fallbacks(language_code)
+        )
+    return request._translation_resolvers[language_code]
+
+
+def _get_related(instances, field):
+    """
+    Sets ``field`` foreign key objects of ``instances`` fetching the
+    missing ones with one query per few hundred, returns the objects
+    """
+    cache_name = field.get_cache_name()
+    missing = set(
+        getattr(obj, field.attname) for obj in instances
+        if not hasattr(obj, cache_name)
+    )
+    missing.discard(None)
+
+    loaded = {}
+    for chunk in chunks(sorted(missing)):
+        loaded.update(field.rel.to._base_manager.in_bulk(chunk))
+
+    related = []
+    for obj in instances:
+        if not hasattr(obj, cache_name):
+            if getattr(obj, field.attname) not in loaded:
+                continue
+            setattr(obj, cache_name, loaded[getattr(obj, field.attname)])
+
+        value = getattr(obj, cache_name)
+        if value is not None:
+            related.append(value)
+    return related
+
+
+def _set_translations(instances, resolver):
+    by_model = defaultdict(dict)
+    for obj in instances:
+        opts = obj._meta
+        if (hasattr(opts, 'translations_model') and
+                getattr(obj, opts.translations_cache, None) is None):
+            by_model[opts.translations_model][id(obj)] = obj
+
+    for translations_model, objects in by_model.iteritems():
+        resolved = resolver.resolve(objects.values(), translations_model,
+                                    'master', 'language_code')
+        for obj in objects.itervalues():
+            if resolved[obj.pk] is not None:
+                setattr(obj, obj._meta.translations_cache, resolved[obj.pk])
+
+
+def prefetch_translations(instances, *lookups, **kwargs):
+    """
+    Loads translations of hvad ``instances`` and of objects they refer
+    to through ``lookups``, foreign key paths like ``'place__city'``.
+
+    Related objects take one query per foreign key and translations one
+    query per translated model, however many instances there are. Every
+    object gets its best translation from ``resolver``, by default a new
+    ``TranslationResolver``, objects with none are left as they are.
+    Objects which already have a translation loaded are kept as they are.
+
+    Returns ``instances`` as a list.
+    """
+    resolver = kwargs.pop('resolver', None) or TranslationResolver()
+    instances = list(instances)
+
+    objects = list(instances)
+    for lookup in lookups:
+        level = instances
+        for name in lookup.split('__'):
+            if not level:
+                break
+            level = _get_related(level, level[0]._meta.get_field(name))
+            objects.extend(level)
+
+    _set_translations(objects, resolver)
+    return instances
@@ -0,0 +1,11 @@
+# sqlite allows 999 query parameters
+CHUNK_SIZE = 300
+
+
+def chunks(values, size=CHUNK_SIZE):
+    """
+    Splits ``values`` into lists short enough to be query parameters
+    """
+    values = list(values)
+    for start in xrange(0, len(values), size):
+        yield values[start:start + size]
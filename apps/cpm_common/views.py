@@ -1,7 +1,19 @@
-from django.http import HttpResponseRedirect, Http404
+import os
+
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.servers.basehttp import FileWrapper
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.conf import settings
+from django.shortcuts import get_object_or_404, render_to_response
+from django.template import RequestContext
 from django.utils.translation import check_for_language
 
+from apps.cpm_common.jobs import (
+    EXPORT_LINK_MAX_AGE, get_download_job, get_download_token, get_export
+)
+from apps.cpm_common.models import ExportJob
+
 def set_language(request, lang_code):
     """
     Redirects from /ru/hello/world/?one=two with setting language
@@ -23,3 +35,41 @@ def set_language(request, lang_code):
 
     return response
 
+
+
+@staff_member_required
+def export_status(request, job_id):
+    job = get_object_or_404(ExportJob, pk=job_id)
+
+    download_url = None
+    if job.status == ExportJob.DONE:
+        download_url = reverse(
+            'export_download', args=[get_download_token(job)]
+        )
+
+    return render_to_response(
+        'cpm_common/export_status.html',
+        {
+            'job': job,
+            'download_url': download_url,
+            'link_max_age': EXPORT_LINK_MAX_AGE // 3600,
+        },
+        context_instance=RequestContext(request),
+    )
+
+
+def export_download(request, token):
+    job = get_download_job(token)
+    if job is None or not os.path.exists(job.file.path):
+        raise Http404
+
+    export = get_export(job)
+    export_file = open(job.file.path, 'rb')
+    response = HttpResponse(
+        FileWrapper(export_file), content_type=export.content_type
+    )
+    response['Content-Length'] = os.fstat(export_file.fileno()).st_size
+    response['Content-Disposition'] = 'attachment; filename="%s"' % (
+        export.filename
+    )
+    return response
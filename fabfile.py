@@ -15,3 +15,4 @@ def update():
         sudo(FILMFEST_MANAGE + 'collectstatic --noinput')
     sudo('systemctl restart filmfest')
     sudo('systemctl restart filmfest_celery')
+    sudo('systemctl restart filmfest_celerybeat')
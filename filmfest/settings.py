@@ -1,5 +1,6 @@
 # Django settings for filmfest project.
 import os.path
+from datetime import timedelta
 from django.utils.translation import ugettext_lazy as _
 
 PROJECT_ROOT = os.path.normpath(os.path.dirname(__file__))
@@ -234,6 +235,59 @@ LOGGING = {
 BROKER_URL = 'redis://localhost:6379/3'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/3'
 CELERY_SEND_TASK_ERROR_EMAILS = True
+CELERYBEAT_SCHEDULE = {
+    # moves task calls stored in apps.cpm_common.outbox to the broker
+    'relay-outbox': {
+        'task': 'apps.cpm_common.tasks.RelayOutbox',
+        'schedule': timedelta(seconds=5),
+    },
+    # sends email queued by apps.cpm_common.mail.queue_email
+    'dispatch-mail': {
+        'task': 'apps.cpm_common.tasks.DispatchMail',
+        'schedule': timedelta(seconds=10),
+    },
+    # sends status update email postponed by apps.cpm2013.models
+    'flush-email-updates': {
+        'task': 'apps.cpm2013.tasks.FlushEmailUpdates',
+        'schedule': timedelta(minutes=1),
+    },
+    # closes preview assignments older than PREVIEW_ASSIGNMENT_MAX_AGE
+    'expire-preview-assignments': {
+        'task': 'apps.cpm2013.tasks.ExpirePreviewAssignments',
+        'schedule': timedelta(hours=1),
+    },
+    'clean-outbox': {
+        'task': 'apps.cpm_common.tasks.CleanOutbox',
+        'schedule': timedelta(days=1),
+    },
+    'clean-exports': {
+        'task': 'apps.cpm_common.tasks.CleanExports',
+        'schedule': timedelta(days=1),
+    },
+}
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_MAX_AGE = 7 * 24 * 60 * 60  # seconds
+
+
+# rendered submission confirmations, see apps.cpm_common.pdf
+PDF_CACHE_DIR = os.path.join(HOME_DIR, 'pdf_cache')
+PDF_CACHE_MAX_SIZE = 100 * 1024 * 1024  # bytes
+
+
+# outgoing mail queue, see apps.cpm_common.mail
+MAIL_BATCH_SIZE = 100
+MAIL_MAX_ATTEMPTS = 5
+MAIL_RATE_LIMIT = 30  # messages per minute to one recipient domain
+MAIL_DOMAIN_RATE_LIMITS = {
+    # 'gmail.com': 60,
+}
+
+
+# background exports, see apps.cpm_common.jobs
+EXPORT_LINK_MAX_AGE = 24 * 60 * 60  # seconds
+EXPORT_MAX_AGE = 7 * 24 * 60 * 60  # seconds
+EXPORT_JOB_TIMEOUT = 30 * 60  # seconds
 
 
 # list of hidden-copy recipients
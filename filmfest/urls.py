@@ -22,6 +22,10 @@ urlpatterns = i18n_patterns('',
     # url(r'^admin/doc/', include('django.contrib.admindocs.urls')),
 
     url(r'^admin/', include(admin.site.urls)),
+    url(r'^exports/(?P<job_id>\d+)/$', 'apps.cpm_common.views.export_status',
+        name='export_status'),
+    url(r'^exports/download/(?P<token>[\w:-]+)/$',
+        'apps.cpm_common.views.export_download', name='export_download'),
 
     url(r'^2012/', include(cpm2012_urls)),
     url(r'^2013/', include(cpm2013_urls)),